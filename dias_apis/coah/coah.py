@@ -6,17 +6,20 @@ EO data access - COAH API
 """
 
 import os
-import time
-import boto3
 import shutil
-import requests
-import requests_cache
 from requests.status_codes import codes
 from datetime import datetime
-from zipfile import ZipFile
-from tqdm import tqdm
 from pathlib import Path
 from utils.auxil import log
+from utils.http import get_session, get_search_session
+from utils.breaker import get_breaker
+from utils.tokens import get_token_cache, invalidate_token
+from utils.s3 import get_client, get_workers, list_objects, download_objects
+from utils.archive import extract_zip, get_extract_workers
+from utils.download import download_file, get_segments, remove_partial, DownloadCancelled
+from utils.race import get_temp_path, get_progress, check, claim
+from utils.search import search_time_windows
+from utils.catalogue import footprint_bbox
 from utils.product_fun import get_satellite_name_from_product_name
 
 # Documentation
@@ -40,16 +43,19 @@ def get_download_requests(auth, start_date, end_date, sensor, resolution, wkt, e
     max_records = 1000
     geometry = wkt.replace(" ", "", 1).strip()
     satellite, product_type = get_dataset_id(sensor, resolution)
-    query = query.format(start_date, end_date, geometry, product_type, satellite, max_records)
-    products = search(satellite, query, env)
+
+    def search_window(window_start, window_end):
+        window_query = query.format(window_start, window_end, geometry, product_type, satellite, max_records)
+        return search(satellite, window_query, env)
+
+    products = search_time_windows(search_window, start_date, end_date, env)
     products = timeliness_filter(products)
     return products
 
 
 def search(satellite, query, env):
     log(env["General"]["log"], "Search for products: {}".format(query))
-    session = requests_cache.CachedSession(os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache"),
-                                           backend='sqlite', expire_after=3600, allowable_methods=('GET', 'POST'))
+    session = get_search_session("COAH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache"))
     products = []
     url = search_address.format(query)
     while True:
@@ -74,9 +80,12 @@ def search(satellite, query, env):
                     "name": feature['Name'],
                     "sensing_start": feature['ContentDate']['Start'],
                     "sensing_end": feature['ContentDate']['End'],
+                    "size": feature.get('ContentLength') or 0,
+                    "checksums": {c['Algorithm']: c['Value'] for c in feature.get('Checksum') or [] if 'Value' in c},
                     "timeliness": timeliness,
                     "product_creation": product_creation,
-                    "satellite": get_satellite_name_from_product_name(feature['Name'])
+                    "satellite": get_satellite_name_from_product_name(feature['Name']),
+                    "footprint": footprint_bbox((feature.get('GeoFootprint') or {}).get('coordinates'))
                 })
             if "@odata.nextLink" in root:
                 log(env["General"]["log"], "Number of products exceeded max records, requesting addition records", indent=1)
@@ -128,77 +137,79 @@ def do_download(auth, product, env, max_attempts=4, wait_time=30, bucket_name="e
     product_path = product["l1_product_path"]
     s3_key = product["s3"]
     os.makedirs(os.path.dirname(product_path), exist_ok=True)
+    breaker = get_breaker("COAH", env)
     for attempt in range(max_attempts):
+        breaker.check()
         if "s3" in env["COAH"] and env["COAH"]["s3"].lower() == "true":
             log(env["General"]["log"], "Starting S3 download attempt {} of {}".format(attempt + 1, max_attempts),
                 indent=1)
-            folder_temp = "{}.incomplete".format(product_path)
+            folder_temp = get_temp_path(product)
             try:
-                s3 = boto3.resource('s3',
-                                    aws_access_key_id=env["COAH"]["access_key"],
-                                    aws_secret_access_key=env["COAH"]["secret_key"],
-                                    endpoint_url=bucket_address, )
-                bucket = s3.Bucket(bucket_name)
+                check(product)
+                client = get_client(env["COAH"]["access_key"], env["COAH"]["secret_key"], endpoint_url=bucket_address,
+                                    workers=get_workers(env["COAH"]))
                 prefix = s3_key.replace("/eodata/", "")
-                objects = [o.key for o in bucket.objects.filter(Prefix=prefix) if not o.key.endswith("/")]
-                for i in range(len(objects)):
-                    print("Downloading sub-file {} ({}/{})".format(os.path.basename(objects[i]), i + 1, len(objects)))
-                    local_path = folder_temp + objects[i].replace(prefix, "")
-                    os.makedirs(os.path.dirname(local_path), exist_ok=True)
-                    bucket.download_file(objects[i], local_path)
+                objects = list_objects(client, bucket_name, prefix)
+                log(env["General"]["log"], "Downloading {} objects".format(len(objects)), indent=2)
+                download_objects(client, bucket_name, objects, lambda key: folder_temp + key.replace(prefix, ""),
+                                 env["General"]["log"], workers=get_workers(env["COAH"]),
+                                 progress=get_progress(product))
+                claim(product)
                 shutil.move(folder_temp, product_path)
                 log(env["General"]["log"], "Download complete", indent=1)
+                breaker.record(True, env["General"]["log"])
                 return
+            except DownloadCancelled:
+                shutil.rmtree(folder_temp, ignore_errors=True)
+                raise
             except Exception as e:
                 log(env["General"]["log"],
                     "Failed S3 download attempt {} of {}: {}".format(attempt + 1, max_attempts, e), indent=1)
                 try:
+                    # The objects in folder_temp are kept, completed ones are skipped by the next attempt
                     if os.path.exists(product_path):
                         shutil.rmtree(product_path)
-                    if os.path.exists(folder_temp):
-                        Path(folder_temp).unlink()
                 except:
                     pass
-                time.sleep(wait_time)
+                breaker.record_error(e, env["General"]["log"])
+                breaker.sleep(attempt, wait_time)
         else:
             log(env["General"]["log"], "Starting download attempt {} of {}".format(attempt + 1, max_attempts), indent=1)
             token = server_authenticate(auth, env)
             os.makedirs(os.path.dirname(product_path), exist_ok=True)
-            file_temp = "{}.incomplete".format(product_path)
-            session = requests.Session()
-            session.headers.update({'Authorization': f'Bearer {token}'})
+            file_temp = get_temp_path(product)
+            session = get_session("COAH")
             url = download_address.format(uuid)
+            downloaded = False
             try:
-                downloaded_bytes = 0
-                with session.get(url, stream=True, timeout=600) as req:
-                    if int(req.status_code) >= 400:
-                        try:
-                            error_msg = req.json()
-                        except:
-                            error_msg = req.text
-                        raise ValueError("{} ERROR. {}".format(req.status_code, error_msg))
-                    with tqdm(unit='B', unit_scale=True, disable=not True) as progress:
-                        chunk_size = 2 ** 20  # download in 1 MB chunks
-                        with open(file_temp, 'wb') as fout:
-                            for chunk in req.iter_content(chunk_size=chunk_size):
-                                if chunk:  # filter out keep-alive new chunks
-                                    fout.write(chunk)
-                                    progress.update(len(chunk))
-                                    downloaded_bytes += len(chunk)
-                with ZipFile(file_temp, 'r') as zip_file:
-                    zip_file.extractall(os.path.dirname(product_path))
+                check(product)
+                download_file(session, url, file_temp, env["General"]["log"], get_segments(env["COAH"]),
+                              headers={'Authorization': f'Bearer {token}'}, progress=get_progress(product),
+                              checksums=product.get("checksums"))
+                downloaded = True
+                claim(product)
+                extract_zip(file_temp, os.path.dirname(product_path), get_extract_workers(env))
                 Path(file_temp).unlink()
+                breaker.record(True, env["General"]["log"])
                 return
+            except DownloadCancelled:
+                remove_partial(file_temp)
+                raise
             except Exception as e:
                 log(env["General"]["log"], "Failed download attempt {} of {}: {}".format(attempt + 1, max_attempts, e), indent=1)
+                if str(e).startswith(("401", "403")):
+                    # The cached token was rejected, fetch a new one for the next attempt
+                    invalidate_token("COAH", auth[0])
                 try:
                     if os.path.exists(product_path):
                         shutil.rmtree(product_path)
-                    if os.path.exists(file_temp):
-                        Path(file_temp).unlink()
+                    # Keep a partial download to resume it, but not a complete one which could not be extracted
+                    if downloaded:
+                        remove_partial(file_temp)
                 except:
                     pass
-                time.sleep(wait_time)
+                breaker.record_error(e, env["General"]["log"])
+                breaker.sleep(attempt, wait_time)
     raise ValueError("Failed to download file after {} attempts".format(max_attempts))
 
 
@@ -208,14 +219,16 @@ def authenticate(env):
 
 def server_authenticate(auth, env, max_attempts=5, wait_time=5):
     username, password = auth
+    cache = get_token_cache("COAH", username, lambda: get_token(username, password), refresh_token)
+    breaker = get_breaker("COAH", env)
     for attempt in range(max_attempts):
+        breaker.check(probe=False)
         try:
-            token = get_token(username, password)
-            log(env["General"]["log"], "Authentication successful.", indent=2)
-            return token
+            return cache.get(env["General"]["log"])
         except Exception as e:
             log(env["General"]["log"], "Failed to authenticate (Attempt {} of {}): {}".format(attempt + 1, max_attempts, e), indent=2)
-            time.sleep(wait_time)
+            breaker.record_error(e, env["General"]["log"])
+            breaker.sleep(attempt, wait_time)
     raise RuntimeError(f'Unable to authenticate with the Copernicus Dataspace server.')
 
 
@@ -226,8 +239,20 @@ def get_token(username, password):
         'password': password,
         'grant_type': 'password',
     }
-    response = requests.post(token_address, data=token_data).json()
-    try:
-        return response['access_token']
-    except KeyError:
+    return post_token_request(token_data)
+
+
+def refresh_token(token):
+    token_data = {
+        'client_id': 'cdse-public',
+        'grant_type': 'refresh_token',
+        'refresh_token': token
+    }
+    return post_token_request(token_data)
+
+
+def post_token_request(token_data):
+    response = get_session("COAH").post(token_address, data=token_data).json()
+    if 'access_token' not in response:
         raise RuntimeError(response)
+    return response
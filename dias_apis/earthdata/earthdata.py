@@ -7,17 +7,18 @@ https://cmr.earthdata.nasa.gov/search/site/docs/search/api.html
 """
 
 import os
-import time
-import requests
-import requests_cache
 from requests.status_codes import codes
-import xml.etree.ElementTree as ET
 from datetime import datetime
-from tqdm import tqdm
-from pathlib import Path
 from utils.auxil import log
+from utils.http import get_session, get_search_session
+from utils.breaker import get_breaker
+from utils.download import download_file
+from utils.catalogue import footprint_bbox
 
-search_address = "https://cmr.earthdata.nasa.gov/search/granules?collection_concept_id={}&bounding_box={}&temporal={},{}&downloadable=true"
+search_address = "https://cmr.earthdata.nasa.gov/search/granules.umm_json?collection_concept_id={}&bounding_box={}&temporal={},{}&downloadable=true"
+
+# Number of granules per page of the search, CMR allows up to 2000
+PAGE_SIZE = 2000
 
 def get_download_requests(auth, start_date, end_date, sensor, resolution, wkt, env):
     if sensor == "PACE_OCI_1B":
@@ -35,32 +36,72 @@ def get_download_requests(auth, start_date, end_date, sensor, resolution, wkt, e
     return products
 
 def search(url, satellite, env):
+    """
+    Search granules with the UMM JSON format of CMR, which contains the name, download url and temporal extent of
+    every granule, so no request per granule is needed. The pages are cached for an hour.
+    """
     log(env["General"]["log"], "Searching for granules")
-    session = requests_cache.CachedSession(os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache"),
-                                           backend='sqlite', expire_after=3600, allowable_methods=('GET', 'POST'))
+    session = get_search_session("EARTHDATA", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache"))
     products = []
+    page = 1
     while True:
-        log(env["General"]["log"], "Calling: {}".format(url), indent=1)
-        response = session.get(url)
-        if response.status_code == codes.OK:
-            root = ET.fromstring(response.content)
-            for reference in root.find("references").findall("reference"):
-                sub_response = requests.get(reference.find("location").text)
-                if sub_response.status_code == codes.OK:
-                    data = sub_response.json()
-                    name = data["DataGranule"]["Identifiers"][0]["Identifier"]
-                    download = [u for u in data["RelatedUrls"] if u["Type"] == "GET DATA"][0]["URL"]
-                    products.append({
-                        "name": name,
-                        "id": reference.find("id").text,
-                        "download": download,
-                        "satellite": satellite,
-                        "sensing_start": data["TemporalExtent"]["RangeDateTime"]["BeginningDateTime"],
-                        "sensing_end": data["TemporalExtent"]["RangeDateTime"]["EndingDateTime"]
-                    })
-            return products
-        else:
+        page_url = "{}&page_size={}&page_num={}".format(url, PAGE_SIZE, page)
+        log(env["General"]["log"], "Calling: {}".format(page_url), indent=1)
+        response = session.get(page_url)
+        if response.status_code != codes.OK:
             raise RuntimeError("Unexpected response: {}".format(response.text))
+        data = response.json()
+        for item in data["items"]:
+            granule = item["umm"]
+            download_url = [u for u in granule["RelatedUrls"] if u["Type"] == "GET DATA"][0]["URL"]
+            products.append({
+                "name": granule["DataGranule"]["Identifiers"][0]["Identifier"],
+                "id": item["meta"]["concept-id"],
+                "download": download_url,
+                "satellite": satellite,
+                "sensing_start": granule["TemporalExtent"]["RangeDateTime"]["BeginningDateTime"],
+                "sensing_end": granule["TemporalExtent"]["RangeDateTime"]["EndingDateTime"],
+                "size": get_size(granule),
+                "checksums": get_checksums(granule, download_url),
+                "footprint": get_footprint(granule)
+            })
+        if len(data["items"]) < PAGE_SIZE or len(products) >= data["hits"]:
+            return products
+        page += 1
+
+
+def get_size(granule):
+    """Return the size of a granule in bytes from its archive information, 0 if it is unknown."""
+    units = {"KB": 2 ** 10, "MB": 2 ** 20, "GB": 2 ** 30}
+    for info in granule.get("DataGranule", {}).get("ArchiveAndDistributionInformation", []):
+        if "SizeInBytes" in info:
+            return int(info["SizeInBytes"])
+        if "Size" in info:
+            return int(float(info["Size"]) * units.get(info.get("SizeUnit", "MB"), 2 ** 20))
+    return 0
+
+
+def get_footprint(granule):
+    """Return the bounding box (min_lon, min_lat, max_lon, max_lat) of the spatial extent of a granule, or None."""
+    geometry = granule.get("SpatialExtent", {}).get("HorizontalSpatialDomain", {}).get("Geometry", {})
+    points = []
+    for rectangle in geometry.get("BoundingRectangles", []):
+        points += [[rectangle["WestBoundingCoordinate"], rectangle["SouthBoundingCoordinate"]],
+                   [rectangle["EastBoundingCoordinate"], rectangle["NorthBoundingCoordinate"]]]
+    for polygon in geometry.get("GPolygons", []):
+        points += [[point["Longitude"], point["Latitude"]] for point in polygon["Boundary"]["Points"]]
+    return footprint_bbox(points)
+
+
+def get_checksums(granule, url):
+    """Return the checksum ({algorithm: hex digest}) of the downloaded file of a granule from its archive information."""
+    for info in granule.get("DataGranule", {}).get("ArchiveAndDistributionInformation", []):
+        checksum = info.get("Checksum", {})
+        if "Algorithm" in checksum and "Value" in checksum and info.get("Name", os.path.basename(url)) == \
+                os.path.basename(url):
+            return {checksum["Algorithm"]: checksum["Value"]}
+    return {}
+
 
 def wkt_to_bounds(wkt):
     points = wkt.replace(" ", "", 1).strip().replace("POLYGON((", "").replace("))", "").split(",")
@@ -83,39 +124,24 @@ def wkt_to_bounds(wkt):
 def do_download(auth, product, env, max_attempts=4, wait_time=30):
     product_path = product["l1_product_path"]
     os.makedirs(os.path.dirname(product_path), exist_ok=True)
+    breaker = get_breaker("EARTHDATA", env)
     for attempt in range(max_attempts):
+        breaker.check()
         log(env["General"]["log"], "Starting download attempt {} of {}".format(attempt + 1, max_attempts), indent=1)
         url = product["download"]
         file_temp = "{}.incomplete".format(product_path)
-        session = requests.Session()
+        session = get_session("EARTHDATA")
         try:
-            downloaded_bytes = 0
-            with session.get(url, stream=True, timeout=600) as req:
-                if int(req.status_code) >= 400:
-                    try:
-                        error_msg = req.json()
-                    except:
-                        error_msg = req.text
-                    raise ValueError("{} ERROR. {}".format(req.status_code, error_msg))
-                with tqdm(unit='B', unit_scale=True, disable=not True) as progress:
-                    chunk_size = 2 ** 20  # download in 1 MB chunks
-                    with open(file_temp, 'wb') as fout:
-                        for chunk in req.iter_content(chunk_size=chunk_size):
-                            if chunk:  # filter out keep-alive new chunks
-                                fout.write(chunk)
-                                progress.update(len(chunk))
-                                downloaded_bytes += len(chunk)
-
+            download_file(session, url, file_temp, env["General"]["log"], checksums=product.get("checksums"))
             os.rename(file_temp, product_path)
+            breaker.record(True, env["General"]["log"])
             return
         except Exception as e:
             log(env["General"]["log"], "Failed download attempt {} of {}: {}".format(attempt + 1, max_attempts, e), indent=1)
             log(env["General"]["log"], "Ensure you have provided EarthData credentials", indent=1)
-            try:
-                Path(file_temp).unlink()
-            except:
-                pass
-            time.sleep(wait_time)
+            # The partial download is kept and resumed by the next attempt
+            breaker.record_error(e, env["General"]["log"])
+            breaker.sleep(attempt, wait_time)
 
 def authenticate(env):
     return
\ No newline at end of file
@@ -7,17 +7,19 @@ EarthExplorer (EE) serves as a key data access portal for the USGS Earth Resourc
 
 import os
 import json
-import boto3
-import time
 import shutil
 import tarfile
-from tqdm import tqdm
 from pathlib import Path
 from datetime import datetime
-import requests
-import requests_cache
 from requests.status_codes import codes
 from utils.auxil import log
+from utils.http import get_session, get_search_session
+from utils.breaker import get_breaker
+from utils.tokens import get_token_cache, invalidate_token
+from utils.s3 import get_client, get_workers, list_objects, download_objects
+from utils.bands import filter_landsat_objects, write_bands_file
+from utils.download import stream_to_file, remove_partial
+from utils.catalogue import footprint_bbox
 from utils.product_fun import get_satellite_name_from_product_name
 
 
@@ -58,8 +60,7 @@ def get_download_requests(auth, start_date, end_date, sensor, resolution, wkt, e
 
 def search(url, payload, env, auth):
     log(env["General"]["log"], "Searching for scenes: {}".format(payload["datasetName"]))
-    session = requests_cache.CachedSession(os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache"),
-                                           backend='sqlite', expire_after=3600, allowable_methods=('GET', 'POST'))
+    session = get_search_session("EROS", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache"))
     products = []
     log(env["General"]["log"], "Calling: {}".format(url), indent=1)
     log(env["General"]["log"], "{}".format(payload), indent=1)
@@ -80,7 +81,8 @@ def search(url, payload, env, auth):
                 "sensing_start": scene['temporalCoverage']['startDate'],
                 "sensing_end": scene['temporalCoverage']['endDate'],
                 "product_creation": scene['publishDate'],
-                "satellite": get_satellite_name_from_product_name(scene['displayId'])
+                "satellite": get_satellite_name_from_product_name(scene['displayId']),
+                "footprint": footprint_bbox((scene.get('spatialBounds') or {}).get('coordinates'))
             })
         return products
     else:
@@ -111,41 +113,43 @@ def do_download(auth, product, env, max_attempts=4, wait_time=30):
     incomplete = "{}.incomplete".format(product_path)
     os.makedirs(os.path.dirname(product_path), exist_ok=True)
     payload = {'datasetName': product['dataset'], 'entityIds': [product["entityId"]]}
+    breaker = get_breaker("EROS", env)
     for attempt in range(max_attempts):
+        breaker.check()
         if "s3" in env["EROS"] and env["EROS"]["s3"].lower() == "true" and attempt < 1:
             log(env["General"]["log"], "Starting S3 download attempt {} of {}".format(attempt + 1, max_attempts),
                 indent=1)
             try:
-                if os.path.exists(incomplete):
+                # A partial API download, objects left in an incomplete folder by a previous run are skipped
+                if os.path.isfile(incomplete):
                     Path(incomplete).unlink()
-                bands = []
-                if "bands" in env["EROS"]:
-                    bands = [b.strip() for b in env["EROS"]["bands"].split(",")]
+                # The bands of the chain are recorded so that a later run needing more completes the download, the
+                # EROS.bands setting applies to every run and is not recorded
+                bands = product.get("bands")
+                if "bands" in env["EROS"] and env["EROS"]["bands"]:
+                    env_bands = [b.strip() for b in env["EROS"]["bands"].split(",")]
+                    bands = env_bands if bands is None else sorted(set(bands) | set(env_bands))
                 parts = product["displayId"].split("_")
                 prefix = ("collection02/level-2/standard/oli-tirs/{}/{}/{}/{}"
                        .format(parts[3][:4], parts[2][:3], parts[2][3:], product["displayId"]))
-                s3 = boto3.client('s3',
-                                    aws_access_key_id=env["AWS"]["aws_access_key_id"],
-                                    aws_secret_access_key=env["AWS"]["aws_secret_access_key"],
-                                    region_name="us-west-2")
-                response = s3.list_objects_v2(Bucket="usgs-landsat", Prefix=prefix, RequestPayer='requester')
-                if 'Contents' in response:
-                    os.makedirs(incomplete)
-                    for obj in response['Contents']:
-                        if len(bands) > 0:
-                            for band in bands:
-                                if obj['Key'].split(".")[0].endswith(band):
-                                    s3.download_file("usgs-landsat", obj['Key'],
-                                                     os.path.join(incomplete, os.path.basename(obj['Key'])),
-                                                     ExtraArgs={'RequestPayer': 'requester'})
-                        else:
-                            s3.download_file("usgs-landsat", obj['Key'],
-                                             os.path.join(incomplete, os.path.basename(obj['Key'])),
-                                             ExtraArgs={'RequestPayer': 'requester'})
-                    os.rename(incomplete, product_path)
-                    return
-                else:
+                client = get_client(env["AWS"]["aws_access_key_id"], env["AWS"]["aws_secret_access_key"],
+                                    region_name="us-west-2", workers=get_workers(env["EROS"]))
+                objects = list_objects(client, "usgs-landsat", prefix, {'RequestPayer': 'requester'})
+                if len(objects) == 0:
                     raise ValueError("Failed to list files")
+                if bands:
+                    objects = filter_landsat_objects(objects, bands)
+                if os.path.isdir(product_path) and not os.path.exists(incomplete):
+                    # Complete the partial download of a previous run which needed fewer bands
+                    os.rename(product_path, incomplete)
+                os.makedirs(incomplete, exist_ok=True)
+                download_objects(client, "usgs-landsat", objects,
+                                 lambda key: os.path.join(incomplete, os.path.basename(key)), env["General"]["log"],
+                                 workers=get_workers(env["EROS"]), extra_args={'RequestPayer': 'requester'})
+                os.rename(incomplete, product_path)
+                write_bands_file(product_path, bands if product.get("bands") is not None else None)
+                breaker.record(True, env["General"]["log"])
+                return
             except Exception as e:
                 log(env["General"]["log"], "Failed download attempt {} of {}: {}".format(attempt + 1, max_attempts, e), indent=1)
                 try:
@@ -155,16 +159,20 @@ def do_download(auth, product, env, max_attempts=4, wait_time=30):
                         shutil.rmtree(incomplete)
                 except:
                     pass
-                time.sleep(wait_time)
+                breaker.record_error(e, env["General"]["log"])
+                breaker.sleep(attempt, wait_time)
         else:
             log(env["General"]["log"], "Starting API download attempt {} of {}".format(attempt + 1, max_attempts),
                 indent=1)
+            downloaded = False
             try:
-                if os.path.exists(incomplete):
+                # A folder left by the S3 download, a partial file of a previous attempt is resumed
+                if os.path.isdir(incomplete):
                     shutil.rmtree(incomplete)
                 token = server_authenticate(auth, env)
                 headers = {'X-Auth-Token': token}
-                response = requests.post(service_url.format("download-options"), json.dumps(payload), headers=headers)
+                session = get_session("EROS")
+                response = session.post(service_url.format("download-options"), json.dumps(payload), headers=headers)
                 if response.status_code != codes.OK:
                     raise ValueError("Failed to access {}".format(service_url.format("download_options")))
                 downloads = []
@@ -175,43 +183,34 @@ def do_download(auth, product, env, max_attempts=4, wait_time=30):
                 label = datetime.now().strftime("%Y%m%d_%H%M%S")  # Customized label using date time
                 payload = {'downloads': downloads,
                            'label': label}
-                response = requests.post(service_url.format("download-request"), json.dumps(payload), headers=headers)
+                response = session.post(service_url.format("download-request"), json.dumps(payload), headers=headers)
                 if response.status_code != codes.OK:
                     raise ValueError("Failed to collect download link")
                 url = response.json()["data"]["availableDownloads"][0]["url"]
-                session = requests.Session()
-                session.headers.update({'X-Auth-Token': f'{token}'})
-                downloaded_bytes = 0
-                with session.get(url, stream=True, timeout=600) as req:
-                    if req.status_code != codes.OK:
-                        try:
-                            error_msg = req.json()
-                        except:
-                            error_msg = req.text
-                        raise ValueError("{} ERROR. {}".format(req.status_code, error_msg))
-                    with tqdm(unit='B', unit_scale=True, disable=not True) as progress:
-                        chunk_size = 2 ** 20  # download in 1 MB chunks
-                        with open(incomplete, 'wb') as fout:
-                            for chunk in req.iter_content(chunk_size=chunk_size):
-                                if chunk:  # filter out keep-alive new chunks
-                                    fout.write(chunk)
-                                    progress.update(len(chunk))
-                                    downloaded_bytes += len(chunk)
+                stream_to_file(session, url, incomplete, env["General"]["log"], headers=headers)
+                downloaded = True
                 os.makedirs(product_path, exist_ok=True)
                 with tarfile.open(incomplete, 'r') as tar_file:
                     tar_file.extractall(product_path)
                 Path(incomplete).unlink()
+                write_bands_file(product_path, None)
+                breaker.record(True, env["General"]["log"])
                 return
             except Exception as e:
                 log(env["General"]["log"], "Failed download attempt {} of {}: {}".format(attempt + 1, max_attempts, e), indent=1)
+                if str(e).startswith(("401", "403")):
+                    # The cached token was rejected, fetch a new one for the next attempt
+                    invalidate_token("EROS", auth[0])
                 try:
                     if os.path.exists(product_path):
                         shutil.rmtree(product_path)
-                    if os.path.exists(incomplete):
-                        Path(incomplete).unlink()
+                    # Keep a partial download to resume it, but not a complete one which could not be extracted
+                    if downloaded:
+                        remove_partial(incomplete)
                 except:
                     pass
-                time.sleep(wait_time)
+                breaker.record_error(e, env["General"]["log"])
+                breaker.sleep(attempt, wait_time)
     raise ValueError("Failed to download file after {} attempts".format(max_attempts))
 
 
@@ -221,14 +220,17 @@ def authenticate(env):
 
 def server_authenticate(auth, env, max_attempts=5, wait_time=5):
     username, password = auth
+    # M2M API keys are valid for two hours and can not be refreshed
+    cache = get_token_cache("EROS", username, lambda: get_token(username, password), lifetime=7200)
+    breaker = get_breaker("EROS", env)
     for attempt in range(max_attempts):
+        breaker.check(probe=False)
         try:
-            token = get_token(username, password)
-            log(env["General"]["log"], "Authentication successful.", indent=2)
-            return token
+            return cache.get(env["General"]["log"])
         except Exception as e:
             log(env["General"]["log"], "Failed to authenticate (Attempt {} of {}): {}".format(attempt + 1, max_attempts, e), indent=2)
-            time.sleep(wait_time)
+            breaker.record_error(e, env["General"]["log"])
+            breaker.sleep(attempt, wait_time)
     raise RuntimeError(f'Unable to authenticate with the Copernicus Dataspace server.')
 
 
@@ -237,8 +239,8 @@ def get_token(username, password):
         "username": username,
         "token": password
     }
-    response = requests.post(service_url.format("login-token"), json.dumps(token_data)).json()
+    response = get_session("EROS").post(service_url.format("login-token"), json.dumps(token_data)).json()
     if isinstance(response["data"], str) and len(response["data"]) > 10:
-        return response["data"]
+        return {"access_token": response["data"]}
     else:
         raise ValueError("Failed")
\ No newline at end of file
@@ -9,7 +9,6 @@ Documentation for HDA API can be found `here. <https://wekeo-broker.apps.mercato
 
 import json
 import os
-import requests
 import time
 
 from requests.auth import HTTPBasicAuth
@@ -17,6 +16,8 @@ from requests.status_codes import codes
 from requests.utils import requote_uri
 from zipfile import ZipFile
 
+from utils.http import get_session
+from utils.ratelimit import get_limiter
 from utils.product_fun import get_lons_lats
 
 # Documentation for HDA API can be found here:
@@ -84,7 +85,7 @@ def get_dataset_id(sensor, resolution):
 def get_access_token(auth):
     print("Getting an access token for user {}. This token is valid for one hour only. URL: {}"
           .format(auth.username, access_token_address))
-    response = requests.get(access_token_address, auth=auth)
+    response = get_session("HDA").get(access_token_address, auth=auth)
     if response.status_code == codes.OK:
         access_token = json.loads(response.text)['access_token']
         print("Success: Access token is {}".format(access_token))
@@ -96,11 +97,11 @@ def get_access_token(auth):
 def accept_tc_if_required(access_token):
     print("Checking if Terms and Conditions are already accepted: {}".format(accept_tc_address))
     headers = {'authorization': access_token}
-    response = requests.get(accept_tc_address, headers=headers)
+    response = get_session("HDA").get(accept_tc_address, headers=headers)
     isTandCAccepted = json.loads(response.text)['accepted']
     if not isTandCAccepted:
         print("Accepting Terms and Conditions of Copernicus_General_License: {}".format(accept_tc_address))
-        response = requests.put(accept_tc_address, headers=headers)
+        response = get_session("HDA").put(accept_tc_address, headers=headers)
         if response.status_code == codes.OK:
             print("Successfully accepted Copernicus_General_License Terms and Conditions.")
         else:
@@ -113,7 +114,7 @@ def query_metadata(access_token, dataset_id):
     encoded_dataset_id = requote_uri(dataset_id)
     print("Getting query metadata from {}".format(metadata_address.format(encoded_dataset_id)))
     headers = {'authorization': access_token}
-    response = requests.get(metadata_address.format(encoded_dataset_id), headers=headers)
+    response = get_session("HDA").get(metadata_address.format(encoded_dataset_id), headers=headers)
     if response.status_code == codes.OK:
         return json.loads(response.text)
     else:
@@ -123,7 +124,7 @@ def query_metadata(access_token, dataset_id):
 def post_datarequest(access_token, datarequest):
     print("Posting datarequest to {}".format(datarequest_address))
     headers = {'authorization': access_token}
-    response = requests.post(datarequest_address, headers=headers, json=datarequest)
+    response = get_session("HDA").post(datarequest_address, headers=headers, json=datarequest)
     if response.status_code == codes.OK:
         job_id = json.loads(response.text)["jobId"]
         print("Query successfully submitted. Job ID is " + job_id)
@@ -136,7 +137,7 @@ def wait_for_datarequest_to_complete(access_token, job_id):
     print("Waiting for data request to complete...")
     headers = {'authorization': access_token}
     while True:
-        response = requests.get(datarequest_status_address.format(job_id), headers=headers)
+        response = get_session("HDA").get(datarequest_status_address.format(job_id), headers=headers)
         if response.status_code == codes.OK:
             if json.loads(response.text)["status"] == "completed":
                 print("Job {} completed!".format(job_id))
@@ -155,7 +156,7 @@ def get_datarequest_results(access_token, job_id):
     headers = {'authorization': access_token}
     datarequest_result_address_paged = datarequest_result_address.format(job_id)
     while True:
-        response = requests.get(datarequest_result_address_paged, headers=headers)
+        response = get_session("HDA").get(datarequest_result_address_paged, headers=headers)
         if response.status_code == codes.OK:
             response_dict = json.loads(response.text)
             for result in response_dict['content']:
@@ -176,7 +177,7 @@ def post_dataorder(access_token, job_id, uri):
         'jobId': job_id,
         'uri': uri
     }
-    response = requests.post(dataorder_address, headers=headers, json=dataorder)
+    response = get_session("HDA").post(dataorder_address, headers=headers, json=dataorder)
     if response.status_code == codes.OK:
         order_id = json.loads(response.text)["orderId"]
         print("Dataorder submitted. Order ID is " + order_id)
@@ -189,7 +190,7 @@ def wait_for_dataorder_to_complete(access_token, order_id):
     print("Waiting for dataorder {} to complete...".format(order_id))
     headers = {'authorization': access_token}
     while True:
-        response = requests.get(dataorder_status_address.format(order_id), headers=headers)
+        response = get_session("HDA").get(dataorder_status_address.format(order_id), headers=headers)
         if response.status_code == codes.OK:
             if json.loads(response.text)["status"] == "completed":
                 print("Dataorder {} completed!".format(order_id))
@@ -205,11 +206,12 @@ def dataorder_download(access_token, order_id, filename):
     print("Downloading data from {}".format(dataorder_download_address.format(order_id)))
     os.makedirs(os.path.dirname(filename), exist_ok=True)
     headers = {'authorization': access_token}
-    response = requests.get(dataorder_download_address.format(order_id), headers=headers, stream=True)
+    response = get_session("HDA").get(dataorder_download_address.format(order_id), headers=headers, stream=True)
     if response.status_code == codes.OK:
         with open(filename + '.zip', 'wb') as down_stream:
             for chunk in response.iter_content(chunk_size=65536):
                 down_stream.write(chunk)
+                get_limiter("HDA").transfer(len(chunk))
         with ZipFile(filename + '.zip', 'r') as zip_file:
             zip_file.extractall(os.path.dirname(filename))
         os.remove(filename + '.zip')
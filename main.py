@@ -6,10 +6,28 @@ import shutil
 import argparse
 import importlib
 import traceback
+import multiprocessing
 from threading import Semaphore, Thread
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 
 from utils.auxil import authenticate_earthdata_anc, init_hindcast, log, authenticate_cds_anc, chmod_recursive
+from utils.logger import configure_logging, set_log_group, flush_logs
 from utils.product_fun import remove_superseded_products, get_l1product_path, filter_for_tiles, filter_for_baseline
+from utils.pipeline import StagePipeline, run_graph
+from utils.catalogue import get_catalogue, search_catalogue
+from utils.breaker import get_breaker, wait_for_backend, BackendUnavailable, MAX_WAITS
+from utils.race import is_race, race_search, race_download
+from utils.priority import PrioritySemaphore, get_download_order, sort_groups, download_priority, prioritized
+from utils.journal import get_journal, close_journal, params_hash, JOURNAL_FILENAME
+from utils.lease import is_distributed, acquire_group_lease, release_group_lease, has_lost_lease
+from utils.bands import is_partial_download, get_band_manifest, has_bands
+from utils.shard import parse_shard, filter_groups, write_shard_summary, merge_shard_summaries
+from utils.http import configure_sessions
+from utils.ratelimit import configure_rate_limits
+from utils.resources import configure_memory_budget, reserve_memory, estimate_nc_memory, gpt_memory, parse_memory, \
+    share_memory_budget, use_memory_budget
+from utils.telemetry import StageTimer, timed_acquire, wait_entry, write_telemetry
 
 conda_env_path = os.environ.get("CONDA_PREFIX")
 if conda_env_path:
@@ -19,9 +37,25 @@ if conda_env_path:
 global summary
 summary = []
 
+# Authenticated download backends by API name, shared between the jobs of a serving worker (None when not serving)
+backend_cache = None
+# Manager and worker processes of executor=process, kept between the jobs of a serving worker (None when not serving)
+worker_pool = None
+
+# Poll interval of the spool directory in serve mode, in seconds
+SPOOL_POLL_SECONDS = 10
+
+# Processors which replace the L1 product of the following processors (they return a list)
+L1_REPLACING_PROCESSORS = ["RADCOR", "TMART"]
+# Processors which read the outputs of other processors without declaring it in the parameters
+IMPLICIT_DEPENDENCIES = {"MPH": ["IDEPIX"]}
+# Default memory footprint in megabytes of the processors which read the L1 product in-process, e.g. the full scene
+# arrays of ACOLITE (overridden by the memory parameter of their section)
+L1_READER_MEMORY = {"POLYMER": 4096, "ACOLITE": 16384, "OCSMART": 8192, "RADCOR": 8192, "TMART": 8192}
+
 
 def sencast(params_file, env_file=None, max_parallel_downloads=1, max_parallel_processors=1,
-            max_parallel_adapters=1):
+            max_parallel_adapters=1, shard=None):
     """
     File-based interface for Sencast.
 
@@ -42,14 +76,19 @@ def sencast(params_file, env_file=None, max_parallel_downloads=1, max_parallel_p
     max_parallel_adapters
         | **Default: 1**
         | Maximum number of adapters to run in parallel
+    shard
+        | **Default: None**
+        | Only run the groups of this shard, given as "i/n" (0 <= i < n)
     """
     l2product_files = {}
     env, params, l2_path = init_hindcast(env_file, params_file)
-    sencast_core(env, params, l2_path, l2product_files, max_parallel_downloads, max_parallel_processors, max_parallel_adapters)
+    sencast_core(env, params, l2_path, l2product_files, max_parallel_downloads, max_parallel_processors,
+                 max_parallel_adapters, parse_shard(shard) if shard else None)
     return l2product_files
 
 
-def sencast_core(env, params, l2_path, l2product_files, max_parallel_downloads=1, max_parallel_processors=1, max_parallel_adapters=1):
+def sencast_core(env, params, l2_path, l2product_files, max_parallel_downloads=1, max_parallel_processors=1,
+                 max_parallel_adapters=1, shard=None):
     """
     Threading function for running Sencast.
     1. Calls API to find available data for given query
@@ -76,8 +115,13 @@ def sencast_core(env, params, l2_path, l2product_files, max_parallel_downloads=1
     max_parallel_adapters
         | **Default: 1**
         | Maximum number of adapters to run in parallel
+    shard
+        | **Default: None**
+        | Tuple (i, n) to only run the groups of shard i out of n, None to run all groups
     """
 
+    configure_logging(env)
+
     # Dynamically import the remote dias api to use
     api = params['General']['remote_dias_api']
 
@@ -86,13 +130,17 @@ def sencast_core(env, params, l2_path, l2product_files, max_parallel_downloads=1
         authenticate_earthdata_anc(env)
     except Exception as e:
         print(e)
-        log(env["General"]["log"], "WARNING failed to create earthdata credential files")
+        log(env["General"]["log"], "WARNING failed to create earthdata credential files", level="WARNING")
 
     try:
         authenticate_cds_anc(env)
     except Exception as e:
         print(e)
-        log(env["General"]["log"], "WARNING failed to create cds credential files")
+        log(env["General"]["log"], "WARNING failed to create cds credential files", level="WARNING")
+
+    configure_memory_budget(env)
+    configure_sessions(max_parallel_downloads)
+    configure_rate_limits(env)
 
     start, end = params['General']['start'], params['General']['end']
     sensor, resolution, wkt = params['General']['sensor'], params['General']['resolution'], params['General']['wkt']
@@ -101,6 +149,10 @@ def sencast_core(env, params, l2_path, l2product_files, max_parallel_downloads=1
 
     download_backends = []
     for api in [a.strip() for a in params['General']['remote_dias_api'].split(",")]:
+        if backend_cache is not None and api in backend_cache:
+            log(env["General"]["log"], "Reusing authenticated API: {}".format(api))
+            download_backends.append(backend_cache[api])
+            continue
         log(env["General"]["log"], "Attempting to authenticate API: {}".format(api))
         try:
             module = importlib.import_module("dias_apis.{}.{}".format(api.lower(), api.lower()))
@@ -109,7 +161,7 @@ def sencast_core(env, params, l2_path, l2product_files, max_parallel_downloads=1
             do_download = getattr(module, "do_download")
             auth = authenticate(env[api])
         except Exception as e:
-            log(env["General"]["log"], "FAILED to access data from {}".format(api))
+            log(env["General"]["log"], "FAILED to access data from {}".format(api), level="ERROR")
             print(e)
             continue
         download_backends.append({
@@ -118,6 +170,8 @@ def sencast_core(env, params, l2_path, l2product_files, max_parallel_downloads=1
             "get_download_requests": get_download_requests,
             "auth": auth,
         })
+        if backend_cache is not None:
+            backend_cache[api] = download_backends[-1]
 
     if not download_backends:
         raise ValueError("Unable to access API's, please check your internet connectivity or try adding an alternative API")
@@ -128,37 +182,59 @@ def sencast_core(env, params, l2_path, l2product_files, max_parallel_downloads=1
             "Download-time failover only supports OData-compatible APIs ({}). "
             "Cannot mix with: {}".format(sorted(ODATA_COMPATIBLE_APIS), non_odata))
 
-    products = False
-    for backend in download_backends:
-        try:
-            products = backend["get_download_requests"](backend["auth"], start, end, sensor, resolution, wkt, env)
-            break
-        except Exception as e:
-            log(env["General"]["log"], "FAILED to list products from {}".format(backend["name"]))
-            print(e)
+    journal = None
+    if "journal" in env["General"] and env["General"]["journal"].lower() == "true":
+        env["General"]["journal_file"] = os.path.join(l2_path, JOURNAL_FILENAME)
+        env["General"]["journal_params_hash"] = params_hash(params)
+        if "overwrite" in params["General"].keys() and params['General']['overwrite'] == "true" \
+                and os.path.isfile(env["General"]["journal_file"]):
+            log(env["General"]["log"], "Removing journal of previous run: {}".format(env["General"]["journal_file"]))
+            close_journal(env["General"]["journal_file"])
+            os.remove(env["General"]["journal_file"])
+        journal = get_journal(env)
+        log(env["General"]["log"], "Recording run in journal: {}".format(env["General"]["journal_file"]))
+
+    products = journal.get_products() if journal else None
+    if products is not None:
+        log(env["General"]["log"], "Using the {} products listed in the journal of a previous run.".format(len(products)))
+    else:
+        catalogue = get_catalogue(env)
+        if catalogue:
+            products = search_catalogue(catalogue, lambda window_start, window_end, area: search_products(
+                env, download_backends, window_start, window_end, sensor, resolution, area), sensor, resolution, wkt,
+                                        start, end, env)
+        else:
+            _, products = search_products(env, download_backends, start, end, sensor, resolution, wkt)
+
+        # filter for timeliness
+        products = remove_superseded_products(products, env)
 
-    if products is False:
-        raise ValueError("Unable to list products from any configured API")
+        # filter for tiles
+        if "tiles" in params['General']:
+            tiles = params['General']["tiles"].replace(" ", "").split(",")
+            products = filter_for_tiles(products, tiles, env)
 
-    # filter for timeliness
-    products = remove_superseded_products(products, env)
+        # filter for baseline
+        products = filter_for_baseline(products, sensor, env)
 
-    # filter for tiles
-    if "tiles" in params['General']:
-        tiles = params['General']["tiles"].replace(" ", "").split(",")
-        products = filter_for_tiles(products, tiles, env)
+        if journal:
+            journal.set_products(products)
 
-    # filter for baseline
-    products = filter_for_baseline(products, sensor, env)
+    bands = get_band_manifest(params) if is_partial_download(env) else None
+    if is_partial_download(env):
+        log(env["General"]["log"], "Bands required by the processors: {}".format(
+            "all" if bands is None else ", ".join(bands)))
 
     # set up inputs for product hindcast
     for product in products:
         product["l1_product_path"] = get_l1product_path(env, product["name"])
+        product["bands"] = bands
 
     semaphores = {
-        'download': Semaphore(max_parallel_downloads),
+        'download': PrioritySemaphore(max_parallel_downloads),
         'process': Semaphore(max_parallel_processors),
-        'adapt': Semaphore(max_parallel_adapters)
+        'adapt': Semaphore(max_parallel_adapters),
+        'claim': Semaphore(max_parallel_processors)
     }
 
     # For readonly local dias, remove unavailable products
@@ -171,7 +247,7 @@ def sencast_core(env, params, l2_path, l2product_files, max_parallel_downloads=1
         log(env["General"]["log"], "{} products are available and will be processed.".format(len(products)))
         log(env["General"]["log"],"Products which are available will not be downloaded because the local DIAS is set to 'readonly'.")
     else:
-        actual_downloads = len([0 for product in products if not os.path.exists(product["l1_product_path"])])
+        actual_downloads = len([0 for product in products if not is_downloaded(journal, product)])
         log(env["General"]["log"], "{} products are already locally available.".format(len(products) - actual_downloads))
         log(env["General"]["log"], "{} products must be downloaded first.".format(actual_downloads))
 
@@ -185,12 +261,42 @@ def sencast_core(env, params, l2_path, l2product_files, max_parallel_downloads=1
 
     log(env["General"]["log"], "The products have been grouped into {} group(s).".format(len(product_groups)))
 
+    if journal:
+        for group in list(product_groups.keys()):
+            group_files = journal.completed("group", "Sencast", group, "")
+            if group_files is not None:
+                l2product_files[group] = group_files
+                del product_groups[group]
+        log(env["General"]["log"], "{} group(s) were completed in a previous run and are skipped.".format(
+            len(l2product_files)))
+
+    if shard:
+        product_groups = filter_groups(product_groups, shard)
+        log(env["General"]["log"], "Running shard {} of {}: {} group(s).".format(shard[0], shard[1],
+                                                                            len(product_groups)))
+
+    download_order = get_download_order(env)
+    if download_order:
+        product_groups = sort_groups(product_groups, download_order)
+        log(env["General"]["log"], "Downloading in {} order.".format(download_order.replace("_", " ")))
+
+    if is_distributed(env):
+        log(env["General"]["log"], "Groups are claimed through leases in {}, shared with other workers.".format(
+            os.path.join(l2_path, "Leases")))
+
     start_time = time.time()
 
     if "threading" in env["General"] and env["General"]["threading"].lower() == "false":
         log(env["General"]["log"], "Each group is run sequentially.")
         for group in product_groups.keys():
             sencast_product_group(env, params, download_backends, product_groups[group], l2_path, l2product_files, semaphores, group)
+    elif "executor" in env["General"] and env["General"]["executor"].lower() == "process":
+        sencast_process_pool(env, params, download_backends, product_groups, l2_path, l2product_files,
+                             max_parallel_downloads, max_parallel_processors, max_parallel_adapters)
+    elif "pipeline" in env["General"] and env["General"]["pipeline"].lower() == "true":
+        log(env["General"]["log"], "Groups are passed through a pipeline of download, processor and adapter workers.")
+        sencast_pipeline(env, params, download_backends, product_groups, l2_path, l2product_files, semaphores,
+                         max_parallel_downloads, max_parallel_processors, max_parallel_adapters)
     else:
         log(env["General"]["log"], "Each group is handled by an individual thread.")
         hindcast_threads = []
@@ -207,23 +313,37 @@ def sencast_core(env, params, l2_path, l2product_files, max_parallel_downloads=1
     log(env["General"]["log"], "", blank=True)
 
     log(env["General"]["log"], "SUMMARY")
-    succeeded = [s for s in summary if s["status"] == "Succeeded"]
-    errors = [e for e in summary if e["status"] == "Failed"]
+    steps = [s for s in summary if s["type"] != "wait"]
+    succeeded = [s for s in steps if s["status"] == "Succeeded"]
+    errors = [e for e in steps if e["status"] == "Failed"]
 
     for p in succeeded:
         log(env["General"]["log"], "SUCCEEDED: {}".format(p))
     for p in errors:
-        log(env["General"]["log"], "FAILED: {}".format(p))
+        log(env["General"]["log"], "FAILED: {}".format(p), level="ERROR")
+
+    try:
+        telemetry_file = write_telemetry(env["General"]["log"], summary)
+        log(env["General"]["log"], "Telemetry written to {}".format(telemetry_file))
+    except Exception as e:
+        log(env["General"]["log"], "Failed to write telemetry: {}".format(e), level="WARNING")
+
+    if shard:
+        shard_file = write_shard_summary(l2_path, shard, summary, l2product_files)
+        log(env["General"]["log"], "Shard summary written to {}".format(shard_file))
 
     if 'set_output_permissions' in env['General'] and env['General']['set_output_permissions'].lower() == "true":
         try:
             log(env["General"]["log"], "Setting output permissions to 777")
             chmod_recursive(l2_path, 0o777)
         except Exception as e:
-            log(env["General"]["log"], "Failed to set output permissions")
+            log(env["General"]["log"], "Failed to set output permissions", level="WARNING")
 
     if len(errors) > 0:
-        raise RuntimeError("Sencast failed for {}/{} processes.".format(len(errors), len(summary)))
+        flush_logs()
+        raise RuntimeError("Sencast failed for {}/{} processes.".format(len(errors), len(steps)))
+    elif is_distributed(env) or shard:
+        log(env["General"]["log"], "Inputs and outputs are kept, as other workers may still be using them.")
     else:
         if 'remove_inputs' in params['General'] and params['General']['remove_inputs'] == "True":
             log(env["General"]["log"], "Deleting input files")
@@ -236,6 +356,24 @@ def sencast_core(env, params, l2_path, l2product_files, max_parallel_downloads=1
         if 'remove_outputs' in params['General'] and params['General']['remove_outputs'] == "True":
             log(env["General"]["log"], "Deleting output files")
             shutil.rmtree(l2_path)
+    flush_logs()
+
+
+def search_products(env, download_backends, start, end, sensor, resolution, wkt):
+    """
+    List the products of a search from the first backend which succeeds. Returns the name of this backend and the
+    products, raises a ValueError if no backend succeeded. With race=True, all backends are searched concurrently.
+    """
+    if is_race(env) and len(download_backends) > 1:
+        return race_search(env, download_backends, start, end, sensor, resolution, wkt)
+    for backend in download_backends:
+        try:
+            return backend["name"], backend["get_download_requests"](backend["auth"], start, end, sensor, resolution,
+                                                                     wkt, env)
+        except Exception as e:
+            log(env["General"]["log"], "FAILED to list products from {}".format(backend["name"]), level="ERROR")
+            print(e)
+    raise ValueError("Unable to list products from any configured API")
 
 
 def sencast_product_group(env, params, download_backends, products, l2_path, l2product_files_outer, semaphores, group):
@@ -265,138 +403,694 @@ def sencast_product_group(env, params, download_backends, products, l2_path, l2p
     group
         Thread group name
     """
+    set_log_group(group)
+    if not is_distributed(env):
+        run_product_group(env, params, download_backends, products, l2_path, l2product_files_outer, semaphores, group)
+        return
+
+    # Claim at most as many groups at a time as can be processed, so the remaining groups are left to other workers
+    with semaphores['claim']:
+        lease = acquire_group_lease(env, l2_path, group)
+        if lease is None:
+            return
+        try:
+            run_product_group(env, params, download_backends, products, l2_path, l2product_files_outer, semaphores,
+                              group)
+        finally:
+            release_group_lease(lease, group in l2product_files_outer and is_group_successful(group))
+
+
+def run_product_group(env, params, download_backends, products, l2_path, l2product_files_outer, semaphores, group):
+    """
+    Run the download, processor and adapter steps of one group, see sencast_product_group.
+    """
     log(env["General"]["log"], "", blank=True)
     log(env["General"]["log"], 'Processing group: "{}"'.format(group))
     log(env["General"]["log"], 'Outputting to folder : "{}"'.format(l2_path))
+    if not download_products(env, download_backends, products, semaphores, group):
+        return
+
+    with timed_acquire(semaphores['process']) as wait_time:
+        summary.append(wait_entry(group, "process", wait_time))
+        l2product_files = process_products(env, params, products, l2_path, group)
+
+    if "adapters" in params["General"]:
+        with timed_acquire(semaphores['adapt']) as wait_time:
+            summary.append(wait_entry(group, "adapt", wait_time))
+            apply_adapters(env, params, l2product_files, group)
+
+    l2product_files_outer[group] = l2product_files
+    record_group(env, group, l2product_files)
+    log(env["General"]["log"], "", blank=True)
+    log(env["General"]["log"], 'Processing group: "{}" complete.'.format(group))
+
+
+def sencast_pipeline(env, params, download_backends, product_groups, l2_path, l2product_files_outer, semaphores,
+                     max_parallel_downloads=1, max_parallel_processors=1, max_parallel_adapters=1):
+    """
+    Run Sencast for all groups through a pipeline of dedicated download, processor and adapter workers, so that
+    the following groups are downloaded while the current group is processed.
+
+    Parameters
+    ----------
+
+    env
+        Dictionary of environment parameters, loaded from input file
+    params
+        Dictionary of parameters, loaded from input file
+    download_backends
+        Ordered list of authenticated DIAS API backends ({"name", "do_download", "auth"})
+    product_groups
+        Dictionary of product lists by group name
+    l2_path
+        The output folder in which to save the output files
+    l2product_files_outer
+        A dictionary to return the outputs (produced l2 product files)
+    semaphores
+        Dictionary of semaphore objects
+    max_parallel_downloads
+        | **Default: 1**
+        | Number of download workers
+    max_parallel_processors
+        | **Default: 1**
+        | Number of processor workers
+    max_parallel_adapters
+        | **Default: 1**
+        | Number of adapter workers
+    """
+    def download(item):
+        set_log_group(item["group"])
+        if is_distributed(env):
+            item["lease"] = acquire_group_lease(env, l2_path, item["group"])
+            if item["lease"] is None:
+                return
+        log(env["General"]["log"], "", blank=True)
+        log(env["General"]["log"], 'Downloading group: "{}"'.format(item["group"]))
+        if download_products(env, download_backends, item["products"], semaphores, item["group"]):
+            return item
+        if item.get("lease"):
+            release_group_lease(item["lease"], False)
+
+    def process(item):
+        set_log_group(item["group"])
+        log(env["General"]["log"], "", blank=True)
+        log(env["General"]["log"], 'Processing group: "{}"'.format(item["group"]))
+        log(env["General"]["log"], 'Outputting to folder : "{}"'.format(l2_path))
+        try:
+            item["l2product_files"] = process_products(env, params, item["products"], l2_path, item["group"])
+        except Exception:
+            if item.get("lease"):
+                release_group_lease(item["lease"], False)
+            raise
+        return item
+
+    def adapt(item):
+        set_log_group(item["group"])
+        if "adapters" in params["General"]:
+            apply_adapters(env, params, item["l2product_files"], item["group"])
+        l2product_files_outer[item["group"]] = item["l2product_files"]
+        record_group(env, item["group"], item["l2product_files"])
+        if item.get("lease"):
+            release_group_lease(item["lease"], is_group_successful(item["group"]))
+        log(env["General"]["log"], "", blank=True)
+        log(env["General"]["log"], 'Processing group: "{}" complete.'.format(item["group"]))
+        return item
+
+    max_ahead = None
+    if "download_ahead" in env["General"] and env["General"]["download_ahead"]:
+        max_ahead = int(env["General"]["download_ahead"])
+        log(env["General"]["log"], "Downloading at most {} products ahead of processing.".format(max_ahead))
+
+    stages = [("download", download, max_parallel_downloads),
+              ("process", process, max_parallel_processors),
+              ("adapt", adapt, max_parallel_adapters)]
+    pipeline = StagePipeline(stages, env["General"]["log"], max_ahead=max_ahead,
+                             weight=lambda item: len(item["products"]), release_stage="process")
+    pipeline.run({"group": group, "products": products} for group, products in product_groups.items())
+
+
+def sencast_process_pool(env, params, download_backends, product_groups, l2_path, l2product_files_outer,
+                         max_parallel_downloads=1, max_parallel_processors=1, max_parallel_adapters=1):
+    """
+    Run Sencast for all groups in a pool of worker processes, so that the processors of different groups are not
+    limited by the GIL. The summary and the l2 product files of every group are returned to the parent process.
+
+    Parameters
+    ----------
+
+    env
+        Dictionary of environment parameters, loaded from input file
+    params
+        Dictionary of parameters, loaded from input file
+    download_backends
+        Ordered list of authenticated DIAS API backends ({"name", "do_download", "auth"})
+    product_groups
+        Dictionary of product lists by group name
+    l2_path
+        The output folder in which to save the output files
+    l2product_files_outer
+        A dictionary to return the outputs (produced l2 product files)
+    max_parallel_downloads
+        | **Default: 1**
+        | Maximum number of parallel downloads of satellite images
+    max_parallel_processors
+        | **Default: 1**
+        | Maximum number of processors to run in parallel
+    max_parallel_adapters
+        | **Default: 1**
+        | Maximum number of adapters to run in parallel
+    """
+    if "max_workers" in env["General"] and env["General"]["max_workers"]:
+        max_workers = int(env["General"]["max_workers"])
+    else:
+        max_workers = os.cpu_count()
+    log(env["General"]["log"], "Each group is run in a pool of {} worker processes.".format(max_workers))
+
+    if worker_pool is None:
+        manager, executor = start_worker_pool(env, max_workers, max_parallel_downloads)
+        try:
+            run_worker_pool(manager, executor, env, params, download_backends, product_groups, l2_path,
+                            l2product_files_outer, max_parallel_downloads, max_parallel_processors,
+                            max_parallel_adapters)
+        finally:
+            executor.shutdown()
+            manager.shutdown()
+        return
+
+    # A serving worker starts the pool for its first job and keeps it, so later jobs skip starting the workers and
+    # importing the processors again
+    if not worker_pool:
+        worker_pool["manager"], worker_pool["executor"] = start_worker_pool(env, max_workers, max_parallel_downloads)
+    try:
+        run_worker_pool(worker_pool["manager"], worker_pool["executor"], env, params, download_backends,
+                        product_groups, l2_path, l2product_files_outer, max_parallel_downloads,
+                        max_parallel_processors, max_parallel_adapters)
+    except BrokenProcessPool:
+        # A crashed worker breaks the pool, the next job starts a new one
+        stop_worker_pool()
+        raise
+
+
+def start_worker_pool(env, max_workers, max_parallel_downloads):
+    """Start the manager of the shared semaphores and the pool of worker processes."""
+    # The workers are started from a clean process instead of forking this one, whose log writer may hold the stdout
+    # lock at the moment of the fork, so they configure themselves in init_worker_process
+    flush_logs()
+    context = multiprocessing.get_context(
+        "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+    manager = context.Manager()
+    executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=init_worker_process,
+                                   initargs=(env, max_parallel_downloads))
+    return manager, executor
+
+
+def stop_worker_pool():
+    """Shut down the worker pool kept by a serving worker."""
+    if worker_pool:
+        worker_pool.pop("executor").shutdown()
+        worker_pool.pop("manager").shutdown()
+
+
+def run_worker_pool(manager, executor, env, params, download_backends, product_groups, l2_path,
+                    l2product_files_outer, max_parallel_downloads, max_parallel_processors, max_parallel_adapters):
+    """Run every group of a job in the worker pool, with semaphores shared through the manager."""
+    semaphores = {
+        'download': manager.Semaphore(max_parallel_downloads),
+        'process': manager.Semaphore(max_parallel_processors),
+        'adapt': manager.Semaphore(max_parallel_adapters),
+        'claim': manager.Semaphore(max_parallel_processors),
+        'memory': share_memory_budget(manager)
+    }
+    flush_logs()
+    futures = {executor.submit(sencast_group_process, env, params, download_backends, products, l2_path,
+                               semaphores, group): group for group, products in product_groups.items()}
+    broken = None
+    for future in as_completed(futures):
+        group = futures[future]
+        try:
+            l2product_files, group_summary = future.result()
+        except Exception as e:
+            log(env["General"]["log"], "Worker process for group {} failed: {}".format(group, e), level="ERROR")
+            summary.append({"group": group, "input": "Multiple", "output": "", "type": "group",
+                            "name": "Process", "status": "Failed", "time": "", "message": str(e)})
+            if isinstance(e, BrokenProcessPool):
+                broken = e
+            continue
+        summary.extend(group_summary)
+        if group in l2product_files:
+            l2product_files_outer[group] = l2product_files[group]
+    if broken is not None:
+        raise broken
+
+
+def init_worker_process(env, max_parallel_downloads):
+    """Apply the process-wide settings of sencast_core in a new worker process."""
+    configure_logging(env)
+    configure_memory_budget(env)
+    configure_sessions(max_parallel_downloads)
+    configure_rate_limits(env)
+
+
+def sencast_group_process(env, params, download_backends, products, l2_path, semaphores, group):
+    """
+    Entry point of a worker process. Runs one group and returns its l2 product files and summary entries.
+    """
+    # Worker processes are reused for several groups
+    del summary[:]
+    use_memory_budget(semaphores['memory'])
+    l2product_files = {}
+    sencast_product_group(env, params, download_backends, products, l2_path, l2product_files, semaphores, group)
+    group_summary = [dict(s, message=str(s["message"])) for s in summary]
+    del summary[:]
+    flush_logs()
+    return l2product_files, group_summary
+
+
+def download_products(env, download_backends, products, semaphores, group):
+    """
+    Download all products of a group which are not locally available, trying the backends in turn (or racing them
+    with race=True).
+    Returns False if a product could not be downloaded from any backend.
+    """
+    journal = get_journal(env)
+    download_order = get_download_order(env)
     for product in products:
-        if not os.path.exists(product["l1_product_path"]):
-            with semaphores['download']:
+        if has_lost_lease(group):
+            log(env["General"]["log"], "Stopping downloads of group {}, it was taken over.".format(group),
+                level="WARNING")
+            return False
+        if not is_downloaded(journal, product):
+            remaining_bytes = sum(p.get("size") or 0 for p in products if not is_downloaded(journal, p)) \
+                if download_order == "complete_groups" else 0
+            priority = download_priority(download_order, product, remaining_bytes)
+            with timed_acquire(prioritized(semaphores['download'], priority)) as wait_time:
+                stage = StageTimer(wait_time)
                 log(env["General"]["log"], "Downloading file: " + product["l1_product_path"])
                 last_exc = None
-                for backend in download_backends:
+                if is_race(env) and len(download_backends) > 1:
                     try:
-                        log(env["General"]["log"], "Attempting download via {}".format(backend["name"]), indent=1)
-                        backend["do_download"](backend["auth"], product, env)
-                        last_exc = None
-                        break
+                        race_download(env, download_backends, product)
                     except (Exception,):
                         last_exc = traceback.format_exc()
-                        log(env["General"]["log"], last_exc, indent=2)
-                        log(env["General"]["log"],
-                            "Download via {} failed; trying next API.".format(backend["name"]), indent=1)
+                        log(env["General"]["log"], last_exc, indent=2, level="WARNING")
+                else:
+                    last_exc = download_failover(env, download_backends, product)
                 if last_exc is not None:
                     log(env["General"]["log"],
-                        "Failed to download file {} from all APIs.".format(product["l1_product_path"]))
+                        "Failed to download file {} from all APIs.".format(product["l1_product_path"]), level="ERROR")
                     summary.append(
                         {"group": group, "input": product["l1_product_path"], "output": "", "type": "download",
-                         "name": "Download", "status": "Failed", "time": "", "message": last_exc})
-                    return
-
-    with semaphores['process']:
-        l2product_files = {}
-        failed_process = False
-        for processor in [p.strip() for p in filter(None, params['General']['processors'].split(","))]:
-            if failed_process:
-                log(env["General"]["log"], "", blank=True)
-                log(env["General"]["log"], "Terminating processing chain after failure")
-                break
+                         "name": "Download", "status": "Failed", "message": last_exc, **stage.stop()})
+                    if journal:
+                        journal.record("download", "Download", "", product["name"], "", "Failed")
+                    return False
+                summary.append(
+                    {"group": group, "input": product["l1_product_path"], "output": product["l1_product_path"],
+                     "type": "download", "name": "Download", "status": "Succeeded", "message": "", **stage.stop()})
+                if journal:
+                    journal.record("download", "Download", "", product["name"], product["l1_product_path"],
+                                   "Succeeded", stage.elapsed())
+    return True
 
-            log(env["General"]["log"], "", blank=True)
-            log(env["General"]["log"], "Processor {} starting...".format(processor))
-            try:
-                process = getattr(
-                    importlib.import_module("processors.{}.{}".format(processor.lower(), processor.lower())), "process")
-            except Exception as e:
-                log(env["General"]["log"], "Failed to import processor.".format(processor))
-                print(e)
-                for product in products:
-                    summary.append(
-                        {"group": group, "input": product["l1_product_path"], "type": "processor", "name": processor,
-                         "status": "Failed", "time": 0,
-                         "message": "Unable to import processor."})
+
+def download_failover(env, download_backends, product):
+    """
+    Download a product from the first backend which succeeds, skipping the backends whose circuit is open. When the
+    circuits of all backends are open, wait for the next attempt they let through (at most MAX_WAITS times). Returns
+    None on success, else the traceback of the last failure.
+    """
+    for wait in range(MAX_WAITS + 1):
+        last_exc = None
+        for backend in download_backends:
+            if not get_breaker(backend["name"], env).available():
+                log(env["General"]["log"], "{} is unavailable; trying next API.".format(backend["name"]), indent=1,
+                    level="WARNING")
                 continue
+            try:
+                log(env["General"]["log"], "Attempting download via {}".format(backend["name"]), indent=1)
+                backend["do_download"](backend["auth"], product, env)
+                return None
+            except BackendUnavailable as e:
+                log(env["General"]["log"], "{}; trying next API.".format(e), indent=1, level="WARNING")
+            except (Exception,):
+                last_exc = traceback.format_exc()
+                log(env["General"]["log"], last_exc, indent=2, level="WARNING")
+                log(env["General"]["log"], "Download via {} failed; trying next API.".format(backend["name"]),
+                    indent=1, level="WARNING")
+        if last_exc is not None:
+            return last_exc
+        if wait == MAX_WAITS:
+            return "The circuits of all APIs are still open after waiting {} times.".format(MAX_WAITS)
+        wait_for_backend([get_breaker(backend["name"], env) for backend in download_backends], env["General"]["log"])
+
+
+def is_downloaded(journal, product):
+    """Check if a product is available locally, using the journal before probing the file system."""
+    if not has_bands(product["l1_product_path"], product.get("bands")):
+        return False
+    if journal and journal.completed("download", "Download", "", product["name"]) is not None:
+        return True
+    return os.path.exists(product["l1_product_path"])
+
+
+def is_group_successful(group):
+    """Check if no step of a group failed, so that it does not have to be run again."""
+    return not [s for s in summary if s["group"] == group and s["status"] == "Failed"]
+
+
+def record_group(env, group, l2product_files):
+    """Record a group as completed in the journal, if there were no failures in this group."""
+    journal = get_journal(env)
+    if journal and is_group_successful(group):
+        journal.record("group", "Sencast", group, "", l2product_files, "Succeeded")
+
+
+def process_products(env, params, products, l2_path, group):
+    """
+    Run the processor chain on all products of a group and mosaic the outputs of every processor.
+    Returns the dictionary of produced l2 product files.
+
+    The chain is run as a graph of (processor, product) nodes, with the dependencies between processors taken from
+    the parameters and one mosaic node per processor joining its products. With processor_workers > 1 in the
+    environment, independent nodes run in parallel, e.g. IDEPIX for one tile while C2RCC runs for another tile.
+    """
+    journal = get_journal(env)
+    l2product_files = {}
+    halt_on_error = "process_halt_on_error" in env["General"] and env["General"]["process_halt_on_error"].lower() == "true"
+    # Index of the first processor of the chain which failed, the later processors are not run (as in a sequential
+    # chain, the failed processor still runs for its other products and mosaics their outputs)
+    state = {"failed_index": None}
 
-            processor_outputs = []
+    modules = {}
+    for processor in [p.strip() for p in filter(None, params['General']['processors'].split(","))]:
+        try:
+            modules[processor] = importlib.import_module("processors.{}.{}".format(processor.lower(), processor.lower()))
+            getattr(modules[processor], "process")
+        except Exception as e:
+            log(env["General"]["log"], "Failed to import processor {}.".format(processor), level="ERROR")
+            print(e)
             for product in products:
-                if product["l1_product_path"] not in l2product_files.keys():
-                    l2product_files[product["l1_product_path"]] = {}
-                if not os.path.exists(product["l1_product_path"]):
-                    log(env["General"]["log"], "Failed. Processor {} requires input file {}.".format(processor, product["l1_product_path"]), indent=1)
-                    summary.append({"group": group, "input": product["l1_product_path"], "type": "processor", "name": processor, "status": "Failed", "time": 0, "message": "Input file {} not available".format(os.path.basename(product["l1_product_path"]))})
-                    continue
-                start = time.time()
+                summary.append(
+                    {"group": group, "input": product["l1_product_path"], "type": "processor", "name": processor,
+                     "status": "Failed", "time": 0,
+                     "message": "Unable to import processor."})
+    processors = [p for p in [p.strip() for p in filter(None, params['General']['processors'].split(","))]
+                  if p in modules]
+    dependencies = get_processor_dependencies(params, processors)
+    processor_outputs = {processor: {} for processor in processors}
+
+    def run_processor(processor, index):
+        product = products[index]
+        process = modules[processor].process
+        l2product_files.setdefault(product["l1_product_path"], {})
+        recorded = journal.completed("processor", processor, group, product["l1_product_path"]) if journal else None
+        if recorded is None and not os.path.exists(product["l1_product_path"]):
+            log(env["General"]["log"], "Failed. Processor {} requires input file {}.".format(processor, product["l1_product_path"]), indent=1, level="ERROR")
+            summary.append({"group": group, "input": product["l1_product_path"], "type": "processor", "name": processor, "status": "Failed", "time": 0, "message": "Input file {} not available".format(os.path.basename(product["l1_product_path"]))})
+            return
+        stage = StageTimer()
+        try:
+            input_file = product["l1_product_path"]
+            if recorded is not None:
+                log(env["General"]["log"], "{} already completed for {} in a previous run.".format(processor, input_file), indent=1)
+                output_file = recorded
+            else:
+                memory = get_processor_memory(params, processor, modules[processor], l2product_files[input_file])
+                with reserve_memory(memory, env["General"]["log"], processor):
+                    log(env["General"]["log"], "{} running for {}.".format(processor, input_file), indent=1)
+                    output_file = process(env, params, input_file, l2product_files[input_file], l2_path)
+                if journal:
+                    journal.record("processor", processor, group, input_file, output_file, "Succeeded",
+                                   stage.elapsed())
+            telemetry = stage.stop()
+            if isinstance(output_file, list):
+                output_file = output_file[0]
+                product["l1_product_path"] = output_file
+                l2product_files[input_file][processor] = False
+            else:
+                l2product_files[input_file][processor] = output_file
+                processor_outputs[processor][index] = output_file
+            log(env["General"]["log"], "{} finished for {} in {}s.".format(processor, input_file, telemetry["time"]), indent=1)
+            summary.append({"group": group, "input": input_file, "output": output_file, "type": "processor", "name": processor, "status": "Succeeded", "message": "", **telemetry})
+        except Exception as e:
+            telemetry = stage.stop()
+            log(env["General"]["log"], traceback.format_exc(), indent=2, level="ERROR")
+            log(env["General"]["log"], "{} failed for {} in {}s.".format(processor, product["l1_product_path"], telemetry["time"]), indent=1, level="ERROR")
+            summary.append({"group": group, "input": product["l1_product_path"], "output": "", "type": "processor", "name": processor, "status": "Failed", "message": e, **telemetry})
+            if journal:
+                journal.record("processor", processor, group, product["l1_product_path"], "", "Failed", telemetry["time"])
+            if halt_on_error:
+                position = processors.index(processor)
+                state["failed_index"] = position if state["failed_index"] is None else \
+                    min(state["failed_index"], position)
+
+    def run_mosaic(processor):
+        outputs = [processor_outputs[processor][i] for i in sorted(processor_outputs[processor].keys())]
+        if len(outputs) == 1:
+            l2product_files[processor] = outputs[0]
+        elif len(outputs) > 1:
+            if "mosaic" in params["General"] and params["General"]["mosaic"] == "False":
+                log(env["General"]["log"], "Mosaic outputs set to false, not mosaicing {}".format(processor), indent=1)
+                l2product_files[processor] = outputs
+            else:
+                stage = StageTimer()
+                mosaic_input = ",".join(outputs)
                 try:
-                    log(env["General"]["log"], "{} running for {}.".format(processor, product["l1_product_path"]), indent=1)
-                    output_file = process(env, params, product["l1_product_path"], l2product_files[product["l1_product_path"]], l2_path)
-                    duration = int(time.time() - start)
-                    input_file = product["l1_product_path"]
-                    if isinstance(output_file, list):
-                        output_file = output_file[0]
-                        product["l1_product_path"] = output_file
-                        l2product_files[input_file][processor] = False
+                    recorded = journal.completed("mosaic", processor, group, mosaic_input) if journal else None
+                    if recorded is not None:
+                        log(env["General"]["log"], "Outputs of processor {} were mosaiced in a previous run.".format(processor), indent=1)
+                        l2product_files[processor] = recorded
                     else:
-                        l2product_files[input_file][processor] = output_file
-                        processor_outputs.append(output_file)
-                    log(env["General"]["log"], "{} finished for {} in .".format(processor, input_file), indent=1)
-                    summary.append({"group": group, "input": input_file, "output": output_file, "type": "processor", "name": processor, "status": "Succeeded", "time": duration, "message": ""})
-                except Exception as e:
-                    duration = int(time.time() - start)
-                    log(env["General"]["log"], traceback.format_exc(), indent=2)
-                    log(env["General"]["log"], "{} failed for {} in {}s.".format(processor, product["l1_product_path"], duration), indent=1)
-                    summary.append({"group": group, "input": product["l1_product_path"], "output": "", "type": "processor", "name": processor, "status": "Failed", "time": duration, "message": e})
-                    if "process_halt_on_error" in env["General"] and env["General"]["process_halt_on_error"].lower() == "true":
-                        failed_process = True
-
-            if len(processor_outputs) == 1:
-                l2product_files[processor] = processor_outputs[0]
-            elif len(processor_outputs) > 1:
-                if "mosaic" in params["General"] and params["General"]["mosaic"] == "False":
-                    log(env["General"]["log"], "Mosaic outputs set to false, not mosaicing {}".format(processor), indent=1)
-                    l2product_files[processor] = processor_outputs
-                else:
-                    start = time.time()
-                    try:
                         log(env["General"]["log"], "Mosaicing outputs of processor {}...".format(processor), indent=1)
                         from mosaic.mosaic import mosaic
-                        l2product_files[processor] = mosaic(env, params, processor_outputs)
-                        duration = int(time.time() - start)
-                        log(env["General"]["log"], "Mosaiced outputs of processor {}.".format(processor), indent=1)
-                        summary.append({"group": group, "input": "Multiple", "output": l2product_files[processor], "type": "mosaic", "name": processor, "status": "Succeeded", "time": duration, "message": ""})
-                    except Exception as e:
-                        duration = int(time.time() - start)
-                        log(env["General"]["log"], traceback.format_exc(), indent=2)
-                        log(env["General"]["log"], "Mosaicing outputs of processor {} failed.".format(processor), indent=1)
-                        summary.append({"group": group, "input": "Multiple", "output": "", "type": "mosaic", "name": processor, "status": "Failed", "time": duration, "message": e})
-            log(env["General"]["log"], "Processor {} complete.".format(processor))
-
-        for product in products:
-            try:
-                del (l2product_files[product["l1_product_path"]])
-            except:
-                log(env["General"]["log"], "Failed to delete: {}".format(product["l1_product_path"]))
-
-    if "adapters" in params["General"]:
-        with semaphores['adapt']:
-            for adapter in [a.strip() for a in filter(None, params['General']['adapters'].split(","))]:
-                start = time.time()
-                try:
-                    log(env["General"]["log"], "", blank=True)
-                    log(env["General"]["log"], "Adapter {} starting...".format(adapter))
-                    apply = getattr(importlib.import_module("adapters.{}.{}".format(adapter.lower(), adapter.lower())),
-                                    "apply")
-                    apply(env, params, l2product_files, group)
-                    duration = int(time.time() - start)
-                    log(env["General"]["log"], "Adapter {} finished.".format(adapter))
-                    summary.append({"group": group, "input": "Multiple", "output": "", "type": "adapter", "name": adapter, "status": "Succeeded", "time": duration, "message": traceback.format_exc()})
+                        l2product_files[processor] = mosaic(env, params, outputs)
+                        if journal:
+                            journal.record("mosaic", processor, group, mosaic_input, l2product_files[processor],
+                                           "Succeeded", stage.elapsed())
+                    log(env["General"]["log"], "Mosaiced outputs of processor {}.".format(processor), indent=1)
+                    summary.append({"group": group, "input": "Multiple", "output": l2product_files[processor], "type": "mosaic", "name": processor, "status": "Succeeded", "message": "", **stage.stop()})
                 except Exception as e:
-                    duration = int(time.time() - start)
-                    log(env["General"]["log"], traceback.format_exc(), indent=2)
-                    log(env["General"]["log"], "Adapter {} failed on product group {}.".format(adapter, group))
-                    summary.append({"group": group, "input": "Multiple", "output": "", "type": "adapter", "name": adapter, "status": "Failed", "time": duration, "message": e})
+                    telemetry = stage.stop()
+                    log(env["General"]["log"], traceback.format_exc(), indent=2, level="ERROR")
+                    log(env["General"]["log"], "Mosaicing outputs of processor {} failed.".format(processor), indent=1, level="ERROR")
+                    summary.append({"group": group, "input": "Multiple", "output": "", "type": "mosaic", "name": processor, "status": "Failed", "message": e, **telemetry})
+                    if journal:
+                        journal.record("mosaic", processor, group, mosaic_input, "", "Failed", telemetry["time"])
+        log(env["General"]["log"], "Processor {} complete.".format(processor))
 
-    l2product_files_outer[group] = l2product_files
+    def run_node(node):
+        set_log_group(group)
+        if has_lost_lease(group):
+            return
+        if state["failed_index"] is not None and processors.index(node[1]) > state["failed_index"]:
+            if not state.get("terminated"):
+                state["terminated"] = True
+                log(env["General"]["log"], "", blank=True)
+                log(env["General"]["log"], "Terminating processing chain after failure")
+            return
+        if node[0] == "processor":
+            run_processor(node[1], node[2])
+        else:
+            run_mosaic(node[1])
+
+    nodes = {}
+    for processor in processors:
+        for index in range(len(products)):
+            nodes[("processor", processor, index)] = [("processor", d, index) for d in dependencies[processor]]
+        nodes[("mosaic", processor)] = [("processor", processor, index) for index in range(len(products))]
+
+    if "processor_workers" in env["General"] and env["General"]["processor_workers"]:
+        workers = int(env["General"]["processor_workers"])
+    else:
+        workers = 1
     log(env["General"]["log"], "", blank=True)
-    log(env["General"]["log"], 'Processing group: "{}" complete.'.format(group))
+    log(env["General"]["log"], "Running processors {} with {} worker(s).".format(", ".join(processors), workers))
+    run_graph(nodes, run_node, workers, env["General"]["log"],
+              priority=lambda node: (processors.index(node[1]), node[0] == "mosaic", node[2] if len(node) > 2 else 0))
+
+    for product in products:
+        try:
+            del (l2product_files[product["l1_product_path"]])
+        except:
+            log(env["General"]["log"], "Failed to delete: {}".format(product["l1_product_path"]), level="WARNING")
+
+    return l2product_files
+
+
+def get_processor_memory(params, processor, module, product_files):
+    """
+    Return the declared memory footprint in megabytes of running a processor on one product. It is read from the
+    memory parameter of the processor section if set, otherwise it is estimated from the raster size (width x height
+    x bands) of the input products named in the parameters, plus the GPT heap for processors calling GPT. Processors
+    reading the L1 product in-process start from their L1_READER_MEMORY. Returns 0 if the footprint is unknown, GPT
+    calls then still reserve their heap on their own.
+    """
+    if processor in params and "memory" in params[processor] and params[processor]["memory"]:
+        return parse_memory(params[processor]["memory"])
+    memory = L1_READER_MEMORY.get(processor, 0)
+    if processor in params:
+        for key, value in params[processor].items():
+            source = value.strip().upper()
+            if key.endswith("processor") and isinstance(product_files.get(source), str):
+                memory += estimate_nc_memory(product_files[source])
+    if memory and hasattr(module, "GPT_XML_FILENAME"):
+        memory += gpt_memory()
+    return memory
+
+
+def get_processor_dependencies(params, processors):
+    """
+    Return the processors every processor of the chain depends on. Dependencies are read from the parameters
+    (e.g. processor=IDEPIX in the C2RCC section, chl_processor and kd_processor for PRIMARYPRODUCTION), completed by
+    the implicit dependencies of some processors. Processors which replace the L1 product (e.g. RADCOR) depend on all
+    earlier processors and all later processors depend on them, as in a sequential chain.
+    """
+    dependencies = {}
+    for i, processor in enumerate(processors):
+        earlier = processors[:i]
+        if processor in L1_REPLACING_PROCESSORS:
+            dependencies[processor] = earlier
+            continue
+        required = list(IMPLICIT_DEPENDENCIES.get(processor, []))
+        if processor in params:
+            for key, value in params[processor].items():
+                if key.endswith("processor"):
+                    required.append(value.strip().upper())
+        required += [p for p in earlier if p in L1_REPLACING_PROCESSORS]
+        dependencies[processor] = [p for p in earlier if p in required]
+    return dependencies
+
+
+def apply_adapters(env, params, l2product_files, group):
+    """Apply the configured adapters to the l2 product files of a group."""
+    journal = get_journal(env)
+    for adapter in [a.strip() for a in filter(None, params['General']['adapters'].split(","))]:
+        if has_lost_lease(group):
+            log(env["General"]["log"], "Not applying adapters to group {}, it was taken over.".format(group),
+                level="WARNING")
+            return
+        stage = StageTimer()
+        try:
+            log(env["General"]["log"], "", blank=True)
+            if journal and journal.completed("adapter", adapter, group, "") is not None:
+                log(env["General"]["log"], "Adapter {} already applied in a previous run.".format(adapter))
+                continue
+            log(env["General"]["log"], "Adapter {} starting...".format(adapter))
+            apply = getattr(importlib.import_module("adapters.{}.{}".format(adapter.lower(), adapter.lower())),
+                            "apply")
+            apply(env, params, l2product_files, group)
+            telemetry = stage.stop()
+            log(env["General"]["log"], "Adapter {} finished.".format(adapter))
+            summary.append({"group": group, "input": "Multiple", "output": "", "type": "adapter", "name": adapter, "status": "Succeeded", "message": traceback.format_exc(), **telemetry})
+            if journal:
+                journal.record("adapter", adapter, group, "", "", "Succeeded", telemetry["time"])
+        except Exception as e:
+            telemetry = stage.stop()
+            log(env["General"]["log"], traceback.format_exc(), indent=2, level="ERROR")
+            log(env["General"]["log"], "Adapter {} failed on product group {}.".format(adapter, group), level="ERROR")
+            summary.append({"group": group, "input": "Multiple", "output": "", "type": "adapter", "name": adapter, "status": "Failed", "message": e, **telemetry})
+            if journal:
+                journal.record("adapter", adapter, group, "", "", "Failed", telemetry["time"])
+
+
+def serve(spool_path, env_file=None, max_parallel_downloads=1, max_parallel_processors=1, max_parallel_adapters=1):
+    """
+    Long-running worker which runs Sencast for every parameter file placed in the spool directory.
+
+    Parameter files (*.ini) are claimed by moving them to the "running" subfolder, so several workers can share one
+    spool directory, and moved to "done" or "failed" afterwards. Imported processors, authenticated download
+    backends and ancillary data credentials are kept between jobs, and so are the worker processes and the
+    multiprocessing manager of executor=process. The thread pools of the other execution modes are created for every
+    job and shut down at its end.
+
+    Parameters
+    ------------
+
+    spool_path
+        Directory to watch for parameter files
+    env_file
+        | **Default: None**
+        | Environment settings read from the environment .ini file, if None provided Sencast will search for file in environments folder.
+    max_parallel_downloads
+        | **Default: 1**
+        | Maximum number of parallel downloads of satellite images
+    max_parallel_processors
+        | **Default: 1**
+        | Maximum number of processors to run in parallel
+    max_parallel_adapters
+        | **Default: 1**
+        | Maximum number of adapters to run in parallel
+    """
+    global backend_cache, worker_pool
+    backend_cache = {}
+    worker_pool = {}
+    for folder in ["running", "done", "failed"]:
+        os.makedirs(os.path.join(spool_path, folder), exist_ok=True)
+    print("Sencast worker serving parameter files from {}".format(spool_path))
+    try:
+        serve_jobs(spool_path, env_file, max_parallel_downloads, max_parallel_processors, max_parallel_adapters)
+    finally:
+        stop_worker_pool()
+
+
+def serve_jobs(spool_path, env_file, max_parallel_downloads, max_parallel_processors, max_parallel_adapters):
+    """Claim and run the parameter files of the spool directory, see serve."""
+    while True:
+        jobs = sorted(f for f in os.listdir(spool_path) if f.endswith(".ini"))
+        if not jobs:
+            time.sleep(SPOOL_POLL_SECONDS)
+            continue
+        params_file = os.path.join(spool_path, "running", jobs[0])
+        try:
+            os.rename(os.path.join(spool_path, jobs[0]), params_file)
+        except OSError:
+            # Claimed by another worker
+            continue
+        print("Running job {}".format(jobs[0]))
+        del summary[:]
+        status = "done"
+        try:
+            l2product_files = {}
+            env, params, l2_path = init_hindcast(env_file, params_file)
+            sencast_core(env, params, l2_path, l2product_files, max_parallel_downloads, max_parallel_processors,
+                         max_parallel_adapters)
+        except Exception as e:
+            print("Job {} failed: {}".format(jobs[0], e))
+            traceback.print_exc()
+            status = "failed"
+        flush_logs()
+        os.replace(params_file, os.path.join(spool_path, status, jobs[0]))
+        print("Job {} {}".format(jobs[0], status))
+
+
+def merge_shards(params_file, env_file=None):
+    """
+    Aggregate the summaries written by the shards of a run (see --shard) and report the overall result.
+
+    Parameters
+    ----------
+
+    params_file
+        Parameter file of the run
+    env_file
+        | **Default: None**
+        | Environment settings read from the environment .ini file, if None provided Sencast will search for file in environments folder.
+    """
+    env, params, l2_path = init_hindcast(env_file, params_file)
+    steps, l2product_files, missing = merge_shard_summaries(l2_path, env["General"]["log"])
+    steps = [s for s in steps if s["type"] != "wait"]
+    errors = [e for e in steps if e["status"] == "Failed"]
+    log(env["General"]["log"], "SUMMARY")
+    log(env["General"]["log"], "{} group(s) completed, {} step(s) succeeded, {} step(s) failed.".format(
+        len(l2product_files), len(steps) - len(errors), len(errors)))
+    for p in errors:
+        log(env["General"]["log"], "FAILED: {}".format(p), level="ERROR")
+    flush_logs()
+    if missing:
+        raise RuntimeError("Summaries of shard(s) {} are missing.".format(", ".join(str(i) for i in missing)))
+    if errors:
+        raise RuntimeError("Sencast failed for {}/{} processes.".format(len(errors), len(steps)))
+    return l2product_files
 
 
 def test_installation(env, delete):
@@ -408,6 +1102,7 @@ def test_installation(env, delete):
     for test in tests:
         if delete:
             _, params, out_path = init_hindcast(env, '{}.ini'.format(test))
+            flush_logs()
             shutil.rmtree(out_path)
         try:
             sencast('{}.ini'.format(test), env_file=env)
@@ -427,11 +1122,26 @@ if __name__ == "__main__":
     parser.add_argument('--adapters', '-a', help="Maximum number of adapters to run in parallel", type=int, default=1)
     parser.add_argument('--tests', '-t', help="Run test scripts to check Sencast installation", action='store_true')
     parser.add_argument('--delete_tests', '-x', help="Delete previous test run.", action='store_true')
+    parser.add_argument('--serve', '-s', help="Run as a worker serving parameter files from this spool directory",
+                        type=str, default=None)
+    parser.add_argument('--shard', '-n', help="Only run shard i of n of the product groups, given as i/n", type=str,
+                        default=None)
+    parser.add_argument('--merge_shards', '-m', help="Merge the summaries of the shards of a run", action='store_true')
     args = parser.parse_args()
     variables = vars(args)
     sys.argv = [sys.argv[0]]
     if variables["tests"]:
         test_installation(variables["environment"], variables["delete_tests"])
+    elif variables["serve"]:
+        serve(variables["serve"],
+              env_file=variables["environment"],
+              max_parallel_downloads=variables["downloads"],
+              max_parallel_processors=variables["processors"],
+              max_parallel_adapters=variables["adapters"])
+    elif variables["merge_shards"]:
+        if variables["parameters"] is None:
+            raise ValueError("Sencast FAILED. Link to parameters file must be provided.")
+        merge_shards(variables["parameters"], env_file=variables["environment"])
     else:
         if variables["parameters"] is None:
             raise ValueError("Sencast FAILED. Link to parameters file must be provided.")
@@ -439,4 +1149,5 @@ if __name__ == "__main__":
                 env_file=variables["environment"],
                 max_parallel_downloads=variables["downloads"],
                 max_parallel_processors=variables["processors"],
-                max_parallel_adapters=variables["adapters"])
+                max_parallel_adapters=variables["adapters"],
+                shard=variables["shard"])
@@ -19,6 +19,8 @@ PARAMS_SECTION = 'COLLECTION'
 OUT_DIR = 'L2C'
 # A pattern for the name of the file to which the output product will be saved (completed with product name)
 OUT_FILENAME = 'L2C_{}.nc'
+# Bands read from the L1 product (used for band-selective downloads)
+REQUIRED_BANDS = ["ST_B10", "QA_PIXEL"]
 # Default number of attempts for the GPT
 DEFAULT_ATTEMPTS = 1
 # Default timeout for the GPT (doesn't apply to last attempt) in seconds
@@ -0,0 +1,83 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Parallel extraction of downloaded product archives.
+
+ZipFile.extractall decompresses one member after the other. extract_zip reads the central directory once and
+extracts the members with a pool of threads, each with its own handle on the archive (zlib releases the GIL while
+decompressing).
+"""
+
+import queue
+from zipfile import ZipFile
+from threading import Thread
+
+# Default number of threads extracting an archive
+DEFAULT_WORKERS = 4
+
+
+def get_extract_workers(env):
+    """Read the number of extraction threads from the General section of the environment."""
+    if "extract_workers" in env["General"] and env["General"]["extract_workers"]:
+        return max(1, int(env["General"]["extract_workers"]))
+    return DEFAULT_WORKERS
+
+
+def extract_zip(zip_path, destination, workers=DEFAULT_WORKERS):
+    """
+    Extract a zip archive with several threads.
+
+    Parameters
+    ----------
+
+    zip_path
+        Path of the archive
+    destination
+        Folder to extract the archive to
+    workers
+        | **Default: 4**
+        | Number of extraction threads
+
+    Returns
+    -------
+    The number of extracted members
+    """
+    with ZipFile(zip_path, "r") as zip_file:
+        infos = [info for info in zip_file.infolist() if not info.is_dir()]
+        # Folder members are created before the workers start, so that empty ones (e.g. AUX_DATA of a SAFE) exist as
+        # after extractall
+        for info in zip_file.infolist():
+            if info.is_dir():
+                zip_file.extract(info, destination)
+
+    # Largest members first, so that one large image does not finish long after all others
+    todo = queue.Queue()
+    for info in sorted(infos, key=lambda i: i.file_size, reverse=True):
+        todo.put(info)
+    errors = []
+
+    def work():
+        with ZipFile(zip_path, "r") as handle:
+            while True:
+                try:
+                    info = todo.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    try:
+                        handle.extract(info, destination)
+                    except FileExistsError:
+                        # Another thread created the same parent folder at the same time
+                        handle.extract(info, destination)
+                except Exception as e:
+                    errors.append((info.filename, e))
+
+    threads = [Thread(target=work, name="Extract-{}".format(i)) for i in range(max(1, min(workers, len(infos))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise ValueError("Failed to extract {} members, e.g. {}: {}".format(len(errors), *errors[0]))
+    return len(infos)
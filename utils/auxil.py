@@ -12,6 +12,8 @@ from http.cookiejar import CookieJar
 from threading import Timer
 from datetime import datetime
 
+from utils.logger import enqueue, flush_logs
+
 project_path = os.path.dirname(__file__)
 
 
@@ -122,7 +124,13 @@ def log_output(res, log_path, indent=2):
 
 
 def gpt_subprocess(cmd, log_path, attempts=1, timeout=False, indent=1):
+    from utils.resources import reserve_memory, gpt_memory
     log(log_path, "Calling '{}'".format(' '.join(cmd)), indent=indent)
+    with reserve_memory(gpt_memory(), log_path, "GPT", indent=indent):
+        return run_gpt_attempts(cmd, log_path, attempts, timeout, indent)
+
+
+def run_gpt_attempts(cmd, log_path, attempts, timeout, indent):
     for attempt in range(attempts):
         process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
         if attempt != attempts - 1 and timeout:
@@ -207,27 +215,26 @@ def load_properties(properties_file, separator_char='=', comment_char='#'):
     return properties_dict
 
 
-def log(file, text, indent=0, blank=False):
+def log(file, text, indent=0, blank=False, level="INFO"):
+    """Queue text for the log file, it is written by the background writer of utils.logger."""
     text = str(text).split(r"\n")
-    with open(file, "a") as file:
-        for t in text:
-            if t != "" or blank:
-                if blank:
-                    out = t
-                else:
-                    out = datetime.now().strftime("%H:%M:%S.%f") + (" " * 3 * (indent + 1)) + t
-                print(out)
-                file.write(out + "\n")
+    now = datetime.now()
+    for t in text:
+        if t != "" or blank:
+            if blank:
+                out = t
+            else:
+                out = now.strftime("%H:%M:%S.%f") + (" " * 3 * (indent + 1)) + t
+            enqueue(file, now.isoformat(), out, level, indent, t)
 
 
 def error(file, e):
     text = str(e).split("\n")
-    with open(file, "a") as file:
-        for t in text:
-            if t != "":
-                out = datetime.now().strftime("%H:%M:%S.%f") + "   ERROR: " + t
-                print(out)
-                file.write(out + "\n")
+    now = datetime.now()
+    for t in text:
+        if t != "":
+            enqueue(file, now.isoformat(), now.strftime("%H:%M:%S.%f") + "   ERROR: " + t, "ERROR", 0, t)
+    flush_logs()
     raise ValueError(str(e))
 
 
@@ -0,0 +1,67 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Band manifests for band-selective downloads.
+
+A processor can declare the bands it reads from the L1 product in the module attribute REQUIRED_BANDS (e.g.
+["ST_B10", "QA_PIXEL"] for Landsat, an empty list if it only reads the outputs of other processors). When
+partial_download=True in the environment and every processor of the chain declares its bands, only the metadata and
+the image files of the union of these bands are fetched from the EROS S3 bucket. Products which were downloaded
+partially get a .bands file next to them listing their bands, so a later run needing more bands downloads the rest.
+
+For now only COLLECTION declares its bands, so partial downloads only apply to Landsat. The bands read by the
+Sentinel-2 readers (e.g. POLYMER) are not verified yet, so chains using them always download complete products.
+"""
+
+import os
+import json
+import importlib
+
+def is_partial_download(env):
+    return "partial_download" in env["General"] and env["General"]["partial_download"].lower() == "true"
+
+
+def get_band_manifest(params):
+    """Return the sorted union of the bands required by the processor chain, or None if all bands are needed."""
+    bands = set()
+    for processor in [p.strip() for p in filter(None, params['General']['processors'].split(","))]:
+        try:
+            module = importlib.import_module("processors.{}.{}".format(processor.lower(), processor.lower()))
+        except Exception:
+            return None
+        required = getattr(module, "REQUIRED_BANDS", None)
+        if required is None:
+            return None
+        bands.update(required)
+    return sorted(bands)
+
+
+def filter_landsat_objects(objects, bands):
+    """Keep all metadata objects of a Landsat product and the images (.TIF) of the given bands."""
+    return [obj for obj in objects if not obj["Key"].upper().endswith(".TIF") or
+            any(obj["Key"].split(".")[0].endswith(band) for band in bands)]
+
+
+def get_bands_file(product_path):
+    return "{}.bands".format(product_path)
+
+
+def write_bands_file(product_path, bands):
+    """Record the bands of a partial download, or remove the record after a complete download (bands=None)."""
+    if bands is None:
+        if os.path.isfile(get_bands_file(product_path)):
+            os.remove(get_bands_file(product_path))
+        return
+    with open(get_bands_file(product_path), "w") as f:
+        json.dump(bands, f)
+
+
+def has_bands(product_path, bands):
+    """Check if a downloaded product contains the given bands (None for all bands)."""
+    if not os.path.isfile(get_bands_file(product_path)):
+        return True
+    if bands is None:
+        return False
+    with open(get_bands_file(product_path), "r") as f:
+        return set(bands).issubset(json.load(f))
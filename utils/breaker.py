@@ -0,0 +1,222 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Circuit breakers of the DIAS APIs, shared by all download threads of a process.
+
+Every backend has one breaker which tracks the outcome of the last breaker_window download and authentication
+attempts. Only failures of the backend itself count (connection errors, timeouts, 429 and 5xx answers), errors of a
+single product (e.g. 404, checksum mismatch, corrupt archive) are neither failures nor successes. When at least
+breaker_failure_rate of the attempts failed, the circuit opens: the backend is skipped by the download loop, and
+running downloads stop retrying it, until breaker_open_seconds passed. Then a single attempt is let through
+(half-open), which closes the circuit when it succeeds, or opens it again for twice as long when it fails. When the
+circuits of all backends are open, downloads wait for the next half-open attempt (up to MAX_WAITS times) instead
+of failing.
+
+Retries wait with exponential backoff and jitter, so threads which failed at the same time do not retry at the same
+time, and their waits are cut short when the circuit opens.
+"""
+
+import time
+import random
+from collections import deque
+from threading import Lock, Condition
+
+from utils.auxil import log
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+# Default number of recent attempts the failure rate is computed from
+DEFAULT_WINDOW = 10
+# Default failure rate at which the circuit opens
+DEFAULT_FAILURE_RATE = 0.5
+# Default seconds the circuit stays open the first time, doubled every time it opens again
+DEFAULT_OPEN_SECONDS = 60
+# Minimum number of attempts before the circuit can open
+MIN_ATTEMPTS = 3
+# Maximum seconds of a backoff wait or of an open circuit
+MAX_WAIT = 900
+# Longest wait between two checks of the breakers while all backends are unavailable
+POLL_SECONDS = 5
+# Times a download waits for the next attempt of a backend when all circuits are open, before it fails
+MAX_WAITS = 3
+# Exceptions of requests, urllib3 and botocore which show that a backend could not be reached
+CONNECTION_ERRORS = {"ConnectionError", "ConnectTimeout", "ReadTimeout", "Timeout", "ChunkedEncodingError",
+                     "ProtocolError", "EndpointConnectionError", "ConnectTimeoutError", "ReadTimeoutError",
+                     "ConnectionClosedError"}
+
+_breakers = {}
+_breakers_lock = Lock()
+
+
+class BackendUnavailable(RuntimeError):
+    """Raised when the circuit of a backend is open."""
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker of one backend.
+
+    Parameters
+    ----------
+
+    name
+        Name of the backend, for the log
+    window
+        | **Default: 10**
+        | Number of recent attempts the failure rate is computed from
+    failure_rate
+        | **Default: 0.5**
+        | Failure rate at which the circuit opens
+    open_seconds
+        | **Default: 60**
+        | Seconds the circuit stays open the first time
+    """
+
+    def __init__(self, name, window=DEFAULT_WINDOW, failure_rate=DEFAULT_FAILURE_RATE,
+                 open_seconds=DEFAULT_OPEN_SECONDS):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.base_open_seconds = open_seconds
+        self.condition = Condition()
+        self.outcomes = deque(maxlen=window)
+        self.state = CLOSED
+        self.opens = 0
+        self.opened_at = 0
+        self.open_seconds = open_seconds
+        self.probe_at = None
+
+    def available(self):
+        """Check if an attempt would be let through, without starting one."""
+        with self.condition:
+            now = time.time()
+            if self.state == OPEN:
+                return now - self.opened_at >= self.open_seconds
+            if self.state == HALF_OPEN:
+                return self.probe_at is None or now - self.probe_at >= self.open_seconds
+            return True
+
+    def remaining(self):
+        """Return the seconds until an attempt would be let through, 0 if it would be now."""
+        with self.condition:
+            now = time.time()
+            if self.state == OPEN:
+                return max(0.0, self.opened_at + self.open_seconds - now)
+            if self.state == HALF_OPEN and self.probe_at is not None:
+                return max(0.0, self.probe_at + self.open_seconds - now)
+            return 0.0
+
+    def check(self, probe=True):
+        """
+        Start an attempt, raise BackendUnavailable if the circuit is open or its half-open attempt is running. With
+        probe=False (e.g. for the authentication within an attempt) only raise if the circuit is open.
+        """
+        with self.condition:
+            now = time.time()
+            if not probe:
+                if self.state == OPEN and now - self.opened_at < self.open_seconds:
+                    raise BackendUnavailable("{} is unavailable, circuit open for another {:.0f} s.".format(
+                        self.name, self.opened_at + self.open_seconds - now))
+                return
+            if self.state == OPEN and now - self.opened_at >= self.open_seconds:
+                self.state = HALF_OPEN
+                self.probe_at = None
+            # An attempt which never recorded its outcome (e.g. a cancelled download) expires after open_seconds
+            if self.state == HALF_OPEN and (self.probe_at is None or now - self.probe_at >= self.open_seconds):
+                self.probe_at = now
+                return
+            if self.state != CLOSED:
+                raise BackendUnavailable("{} is unavailable, circuit open for another {:.0f} s.".format(
+                    self.name, max(self.opened_at + self.open_seconds, (self.probe_at or 0) + self.open_seconds)
+                    - now))
+
+    def record(self, success, log_path=None):
+        """Record the outcome of an attempt, opening or closing the circuit."""
+        with self.condition:
+            self.outcomes.append(success)
+            if self.state == HALF_OPEN:
+                if success:
+                    self.state, self.opens, self.probe_at = CLOSED, 0, None
+                    self.outcomes.clear()
+                    self.condition.notify_all()
+                    if log_path:
+                        log(log_path, "Circuit of {} closed.".format(self.name), indent=1)
+                else:
+                    self.open(log_path)
+            elif self.state == CLOSED and not success and len(self.outcomes) >= MIN_ATTEMPTS and \
+                    self.outcomes.count(False) >= self.failure_rate * len(self.outcomes):
+                self.open(log_path)
+
+    def record_error(self, error, log_path=None):
+        """
+        Record a failed attempt if its error is a failure of the backend. Other errors do not count, but end a
+        half-open attempt so that the next one can probe the backend.
+        """
+        if is_backend_failure(error):
+            self.record(False, log_path)
+            return
+        with self.condition:
+            if self.state == HALF_OPEN:
+                self.probe_at = None
+                self.condition.notify_all()
+
+    def open(self, log_path=None):
+        self.open_seconds = min(MAX_WAIT, self.base_open_seconds * 2 ** self.opens)
+        self.state, self.opened_at, self.probe_at = OPEN, time.time(), None
+        self.opens += 1
+        if log_path:
+            log(log_path, "Circuit of {} opened for {:.0f} s after {} of {} failed attempts.".format(
+                self.name, self.open_seconds, self.outcomes.count(False), len(self.outcomes)), indent=1,
+                level="WARNING")
+        self.condition.notify_all()
+
+    def sleep(self, attempt, wait_time):
+        """Wait before retrying: exponential backoff from wait_time with jitter, cut short when the circuit opens."""
+        delay = min(MAX_WAIT, wait_time * 2 ** attempt)
+        with self.condition:
+            self.condition.wait_for(lambda: self.state == OPEN, timeout=delay / 2 + random.uniform(0, delay / 2))
+
+
+def get_status(error):
+    """Return the HTTP status of an error (raise_for_status or botocore ClientError), None if it has none."""
+    response = getattr(error, "response", None)
+    if isinstance(response, dict):
+        return response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    status = str(error).split(" ")[0]
+    return int(status) if status.isdigit() else None
+
+
+def is_backend_failure(error):
+    """Check if an error (or its cause) shows that the backend is unavailable rather than a problem of a product."""
+    while error is not None:
+        if isinstance(error, (ConnectionError, TimeoutError)) or \
+                any(cls.__name__ in CONNECTION_ERRORS for cls in type(error).__mro__):
+            return True
+        status = get_status(error)
+        if status is not None and (status == 429 or status >= 500):
+            return True
+        error = error.__cause__
+    return False
+
+
+def wait_for_backend(breakers, log_path=None):
+    """Wait until one of the breakers lets an attempt through, e.g. the next half-open attempt."""
+    if log_path and not any(breaker.available() for breaker in breakers):
+        log(log_path, "The circuits of all APIs are open, waiting {:.0f} s for the next attempt.".format(
+            min(breaker.remaining() for breaker in breakers)), indent=1, level="WARNING")
+    while not any(breaker.available() for breaker in breakers):
+        time.sleep(max(0.1, min(POLL_SECONDS, min(breaker.remaining() for breaker in breakers))))
+
+
+def get_breaker(name, env):
+    """Return the circuit breaker of a backend, created on first use with the settings of the DIAS section."""
+    with _breakers_lock:
+        if name not in _breakers:
+            dias = env["DIAS"]
+            _breakers[name] = CircuitBreaker(
+                name,
+                int(dias["breaker_window"]) if "breaker_window" in dias and dias["breaker_window"] else DEFAULT_WINDOW,
+                float(dias["breaker_failure_rate"]) if "breaker_failure_rate" in dias and
+                dias["breaker_failure_rate"] else DEFAULT_FAILURE_RATE,
+                float(dias["breaker_open_seconds"]) if "breaker_open_seconds" in dias and
+                dias["breaker_open_seconds"] else DEFAULT_OPEN_SECONDS)
+        return _breakers[name]
@@ -0,0 +1,205 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Persistent local catalogue of the products found by the DIAS APIs.
+
+The catalogue is a SQLite database (by default sencast_catalogue.sqlite in the root of the DIAS folder) which stores
+every product returned by get_download_requests with the bounding box of its footprint (the "footprint" entry of the
+product), indexed by sensor, resolution and sensing time, together with the time ranges already searched for a sensor,
+resolution and bounding box. The APIs are searched with the bounding box of the area, so a search is covered by every
+earlier search of a bounding box containing it, e.g. of the same lake with a slightly different WKT. A search only
+queries the remote API for the parts of the requested time range which are not yet covered, so a daily run queries
+one day, and a reprocessing of a covered period needs no API call at all. The stored products whose footprint
+intersects the bounding box of the area are returned.
+
+The last catalogue_latency_days before now are never marked as covered, as products (and reprocessed versions of
+them) are published with a delay.
+"""
+
+import os
+import json
+import sqlite3
+from threading import Lock
+from datetime import datetime, timedelta
+
+from utils.auxil import log
+from utils.product_fun import get_south_east_north_west_bound
+from utils.search import format_date
+
+# The name of the catalogue database in the root of the DIAS folder
+CATALOGUE_FILENAME = "sencast_catalogue.sqlite"
+# Default number of days before now which are searched again by every run
+DEFAULT_LATENCY_DAYS = 7
+# Version of the tables, catalogues of older versions are recreated
+SCHEMA_VERSION = 2
+
+_catalogues = {}
+_catalogues_lock = Lock()
+
+
+def get_catalogue_path(env):
+    """Return the path of the catalogue from the catalogue setting of the DIAS section, or None if disabled."""
+    setting = env["DIAS"]["catalogue"].strip() if "catalogue" in env["DIAS"] else ""
+    if not setting or setting.lower() == "false":
+        return None
+    if setting.lower() == "true":
+        # The root of the DIAS folder is the fixed part of the l1 path pattern
+        root = os.path.dirname(env["DIAS"]["l1_path"].split("{")[0])
+        return os.path.join(root, CATALOGUE_FILENAME)
+    return setting
+
+
+def get_catalogue(env):
+    """Return the catalogue, or None if it is disabled. Connections are opened once per process."""
+    path = get_catalogue_path(env)
+    if path is None:
+        return None
+    key = (os.getpid(), path)
+    with _catalogues_lock:
+        if key not in _catalogues:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            _catalogues[key] = Catalogue(path)
+        return _catalogues[key]
+
+
+def get_bbox(wkt):
+    """Return the bounding box (min_lon, min_lat, max_lon, max_lat) of a WKT polygon."""
+    south, east, north, west = get_south_east_north_west_bound(wkt)
+    return west, south, east, north
+
+
+def bbox_to_wkt(bbox):
+    min_lon, min_lat, max_lon, max_lat = bbox
+    return "POLYGON (({0} {1}, {2} {1}, {2} {3}, {0} {3}, {0} {1}))".format(min_lon, min_lat, max_lon, max_lat)
+
+
+def footprint_bbox(coordinates):
+    """Return the bounding box of the (nested) [lon, lat] coordinates of a GeoJSON geometry, None if there are none."""
+    points = []
+
+    def collect(value):
+        if value and isinstance(value[0], (int, float)):
+            points.append(value)
+        else:
+            for item in value or []:
+                collect(item)
+    collect(coordinates)
+    if not points:
+        return None
+    return [min(p[0] for p in points), min(p[1] for p in points), max(p[0] for p in points),
+            max(p[1] for p in points)]
+
+
+def parse_date(date):
+    return datetime.fromisoformat(date.replace("Z", "").replace(" ", "T"))
+
+
+def subtract_ranges(start, end, ranges):
+    """Return the parts of [start, end] not covered by any of the (start, end) ranges."""
+    gaps = []
+    for range_start, range_end in sorted(ranges):
+        if range_end <= start:
+            continue
+        if range_start >= end:
+            break
+        if range_start > start:
+            gaps.append((start, range_start))
+        start = max(start, range_end)
+    if start < end:
+        gaps.append((start, end))
+    return gaps
+
+
+class Catalogue(object):
+    """SQLite backed catalogue of products and searched time ranges."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.connection:
+            if self.connection.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                self.connection.execute("DROP TABLE IF EXISTS products")
+                self.connection.execute("DROP TABLE IF EXISTS coverage")
+                self.connection.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+            self.connection.execute("CREATE TABLE IF NOT EXISTS products (sensor TEXT, resolution TEXT, name TEXT, "
+                                    "api TEXT, satellite TEXT, sensing_start TEXT, sensing_end TEXT, "
+                                    "timeliness TEXT, min_lon REAL, min_lat REAL, max_lon REAL, max_lat REAL, "
+                                    "product TEXT, updated TEXT, PRIMARY KEY (sensor, resolution, name))")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS products_time ON products "
+                                    "(sensor, resolution, sensing_start)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS coverage (sensor TEXT, resolution TEXT, "
+                                    "min_lon REAL, min_lat REAL, max_lon REAL, max_lat REAL, start TEXT, end TEXT, "
+                                    "api TEXT, updated TEXT)")
+
+    def gaps(self, sensor, resolution, bbox, start, end):
+        """Return the parts of [start, end] which were not yet searched for a bounding box containing bbox."""
+        min_lon, min_lat, max_lon, max_lat = bbox
+        with self.lock:
+            ranges = [(datetime.fromisoformat(s), datetime.fromisoformat(e)) for s, e in self.connection.execute(
+                "SELECT start, end FROM coverage WHERE sensor = ? AND resolution = ? AND min_lon <= ? AND "
+                "min_lat <= ? AND max_lon >= ? AND max_lat >= ?",
+                (sensor, resolution, min_lon, min_lat, max_lon, max_lat))]
+        return subtract_ranges(parse_date(start), parse_date(end), ranges)
+
+    def add(self, api, sensor, resolution, bbox, products, start, end, latency_days=DEFAULT_LATENCY_DAYS):
+        """
+        Store the products found by searching bbox between start and end (dates) and mark the range as covered.
+        Products without a footprint are stored with the searched bounding box.
+        """
+        now = datetime.utcnow().isoformat()
+        rows = [(sensor, resolution, p["name"], api, p.get("satellite", ""), parse_date(p["sensing_start"])
+                 .isoformat(), p.get("sensing_end", ""), p.get("timeliness", ""), *(p.get("footprint") or bbox),
+                 json.dumps(p, default=str), now) for p in products]
+        covered_end = min(end, datetime.utcnow() - timedelta(days=latency_days))
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, "
+                                        "?, ?)", rows)
+            if covered_end > start:
+                self.connection.execute("INSERT INTO coverage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+                    sensor, resolution, *bbox, start.isoformat(), covered_end.isoformat(), api, now))
+
+    def products(self, sensor, resolution, bbox, start, end):
+        """Return the stored products of a sensor and resolution whose footprint intersects bbox, sensed between
+        start and end."""
+        min_lon, min_lat, max_lon, max_lat = bbox
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT product FROM products WHERE sensor = ? AND resolution = ? AND sensing_start >= ? "
+                "AND sensing_start <= ? AND min_lon <= ? AND max_lon >= ? AND min_lat <= ? AND max_lat >= ? "
+                "ORDER BY sensing_start", (sensor, resolution, parse_date(start).isoformat(),
+                                           parse_date(end).isoformat(), max_lon, min_lon, max_lat, min_lat))
+            return [json.loads(row[0]) for row in rows]
+
+
+def search_catalogue(catalogue, search, sensor, resolution, wkt, start, end, env):
+    """
+    Return the products of [start, end] from the catalogue, searching the remote API only for the uncovered parts.
+
+    Parameters
+    ----------
+
+    catalogue
+        Catalogue, see get_catalogue
+    search
+        Function searching the remote API for a (start, end, wkt) range and area, returning the name of the API and
+        the products
+    sensor, resolution, wkt, start, end
+        The search of the parameter file
+    env
+        Dictionary of environment parameters, for the catalogue_latency_days setting and the log
+    """
+    latency_days = int(env["DIAS"]["catalogue_latency_days"]) if "catalogue_latency_days" in env["DIAS"] and \
+        env["DIAS"]["catalogue_latency_days"] else DEFAULT_LATENCY_DAYS
+    bbox = get_bbox(wkt)
+    gaps = catalogue.gaps(sensor, resolution, bbox, start, end)
+    if not gaps:
+        log(env["General"]["log"], "The search is covered by the catalogue {}, no API call needed.".format(
+            catalogue.path))
+    for gap_start, gap_end in gaps:
+        log(env["General"]["log"], "Searching {} to {}, not covered by the catalogue.".format(
+            format_date(gap_start), format_date(gap_end)))
+        api, products = search(format_date(gap_start), format_date(gap_end), bbox_to_wkt(bbox))
+        catalogue.add(api, sensor, resolution, bbox, products, gap_start, gap_end, latency_days)
+    return catalogue.products(sensor, resolution, bbox, start, end)
@@ -0,0 +1,376 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Resumable HTTP downloads for the DIAS APIs.
+
+The body is streamed to the .incomplete file of a product. The validators of the response (ETag, Last-Modified) and
+its total size are stored next to it in a .meta file. When a download attempt fails, the partial file is kept and the
+next attempt requests only the remaining bytes with a Range header. The If-Range header makes the server send the
+whole file instead, if it changed in the meantime, and servers which do not support ranges answer with the whole
+file as well. In both cases the download restarts from the first byte. Without validators, the total size given in
+the Content-Range of the answer must match the size of the first attempt.
+
+With segments > 1, download_file splits the file into byte ranges which are fetched in parallel and written with
+os.pwrite into the preallocated .incomplete file. The progress of every segment is kept in the .meta file, so a failed
+attempt is resumed segment by segment as well. Servers without range support are downloaded in a single stream.
+
+Downloaded chunks are counted against the bandwidth limit of the backend of the session, see utils.ratelimit.
+
+When the checksums of the product are known (e.g. the OData Checksum attribute), the MD5 or SHA (or BLAKE3, if the
+blake3 package is installed) of the file is computed from the chunks while they are written, only the part of a resumed file
+which is already on disk is read once. Segments arrive out of order, so segmented downloads are hashed after the last
+segment, while the file is still in the page cache. A file with a wrong checksum is removed and downloaded again
+right away.
+
+A progress function passed to download_file is called with the size of every written chunk. It can abort the download
+by raising DownloadCancelled, the partial file is then removed.
+"""
+
+import os
+import json
+import time
+import hashlib
+from tqdm import tqdm
+from pathlib import Path
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.auxil import log
+from utils.ratelimit import get_limiter
+
+# Download in 1 MB chunks
+CHUNK_SIZE = 2 ** 20
+# Minimum size of the segments of a segmented download
+MIN_SEGMENT_SIZE = 16 * 2 ** 20
+# Attempts per segment of a segmented download before the whole attempt fails
+SEGMENT_ATTEMPTS = 3
+# Downloads of a file before a checksum mismatch fails the attempt
+CHECKSUM_ATTEMPTS = 2
+# Checksum algorithms of the APIs available in hashlib, in order of preference
+HASHLIB_ALGORITHMS = {"MD5": "md5", "SHA-256": "sha256", "SHA-512": "sha512", "SHA-1": "sha1"}
+
+
+class DownloadCancelled(Exception):
+    """Raised by a progress function to abort a download, e.g. by the losing backend of a race."""
+
+
+class ChecksumMismatch(ValueError):
+    """Raised when the checksum of a downloaded file does not match the published one."""
+
+
+def get_meta_file(file_temp):
+    return "{}.meta".format(file_temp)
+
+
+def read_meta(file_temp):
+    try:
+        with open(get_meta_file(file_temp), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_meta(file_temp, meta):
+    with open(get_meta_file(file_temp), "w") as f:
+        json.dump(meta, f)
+
+
+def remove_partial(file_temp):
+    """Remove a partial download together with its metadata, e.g. after its content turned out to be corrupt."""
+    for file in [file_temp, get_meta_file(file_temp)]:
+        if os.path.isfile(file):
+            Path(file).unlink()
+
+
+def get_validator(meta):
+    return meta.get("etag") or meta.get("last_modified")
+
+
+def raise_for_status(req):
+    if int(req.status_code) >= 400:
+        try:
+            error_msg = req.json()
+        except Exception:
+            error_msg = req.text
+        raise ValueError("{} ERROR. {}".format(req.status_code, error_msg))
+
+
+def stream_to_file(session, url, file_temp, log_path, headers=None, timeout=600, progress=None, hasher=None):
+    """
+    Download url to file_temp, continuing a partial download left by a previous attempt.
+
+    Parameters
+    ----------
+
+    session
+        requests.Session (or the requests module) used for the request
+    url
+        Url of the file to download
+    file_temp
+        Path of the (partial) download
+    log_path
+        Log file
+    headers
+        | **Default: None**
+        | Additional headers of the request
+    timeout
+        | **Default: 600**
+        | Timeout of the request in seconds
+    progress
+        | **Default: None**
+        | Function called with the size of every written chunk, which may raise DownloadCancelled
+    hasher
+        | **Default: None**
+        | hashlib object updated with the content of the file, see get_hasher
+
+    Returns
+    -------
+    The number of bytes transferred by this call
+    """
+    headers = dict(headers) if headers else {}
+    limiter = get_limiter(getattr(session, "backend", ""))
+    meta = read_meta(file_temp)
+    if "segments" in meta:
+        # A preallocated segmented download can not be continued as a single stream
+        remove_partial(file_temp)
+        meta = {}
+    offset = os.path.getsize(file_temp) if os.path.isfile(file_temp) else 0
+    if offset and meta.get("length") and offset > meta["length"]:
+        # A partial file larger than the remote file can not be a prefix of it, start over
+        log(log_path, "Partial download is larger than the remote file, restarting.", indent=2, level="WARNING")
+        remove_partial(file_temp)
+        meta, offset = {}, 0
+    if offset and (get_validator(meta) or meta.get("length")):
+        if meta.get("length") and offset == meta["length"]:
+            log(log_path, "Download already complete.", indent=2)
+            Path(get_meta_file(file_temp)).unlink()
+            if hasher is not None:
+                hash_file(file_temp, hasher)
+            return 0
+        headers["Range"] = "bytes={}-".format(offset)
+        if get_validator(meta):
+            headers["If-Range"] = get_validator(meta)
+    else:
+        offset = 0
+
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as req:
+        if req.status_code == 416 and offset:
+            # The requested range starts at or beyond the end of the file, the partial file is not usable
+            remove_partial(file_temp)
+            raise ValueError("416 ERROR. Partial download does not match the remote file.")
+        raise_for_status(req)
+        if req.status_code == 206:
+            start, length = parse_content_range(req.headers.get("Content-Range", ""))
+            if start != offset or (meta.get("length") and length and length != meta["length"]):
+                remove_partial(file_temp)
+                raise ValueError("Server returned range {} instead of {}.".format(req.headers.get("Content-Range"),
+                                                                                  offset))
+            log(log_path, "Resuming download at {:.1f} MB.".format(offset / 2 ** 20), indent=2)
+            if hasher is not None:
+                hash_file(file_temp, hasher)
+            mode = "ab"
+        else:
+            if offset:
+                log(log_path, "Server does not support resuming this download, restarting it.", indent=2)
+            offset = 0
+            # With a Content-Encoding, the Content-Length is the size of the encoded body
+            length = int(req.headers["Content-Length"]) \
+                if "Content-Length" in req.headers and "Content-Encoding" not in req.headers else None
+            meta = {"etag": req.headers.get("ETag"), "last_modified": req.headers.get("Last-Modified"),
+                    "length": length}
+            # A weak ETag must not be used in If-Range
+            if meta["etag"] and meta["etag"].startswith("W/"):
+                meta["etag"] = None
+            write_meta(file_temp, meta)
+            mode = "wb"
+
+        downloaded_bytes = 0
+        try:
+            with tqdm(unit='B', unit_scale=True, initial=offset, total=meta.get("length")) as progress_bar:
+                with open(file_temp, mode) as fout:
+                    for chunk in req.iter_content(chunk_size=CHUNK_SIZE):
+                        if chunk:  # filter out keep-alive new chunks
+                            fout.write(chunk)
+                            if hasher is not None:
+                                hasher.update(chunk)
+                            progress_bar.update(len(chunk))
+                            downloaded_bytes += len(chunk)
+                            limiter.transfer(len(chunk))
+                            if progress is not None:
+                                progress(len(chunk))
+        except DownloadCancelled:
+            remove_partial(file_temp)
+            raise
+
+    size = os.path.getsize(file_temp)
+    if meta.get("length") and size != meta["length"]:
+        raise ValueError("Incomplete download: {} of {} bytes.".format(size, meta["length"]))
+    Path(get_meta_file(file_temp)).unlink()
+    return downloaded_bytes
+
+
+def parse_content_range(content_range):
+    """Return start and total length of a Content-Range header such as "bytes 100-199/1000"."""
+    try:
+        unit, spec = content_range.split(" ")
+        start = int(spec.split("-")[0])
+        total = spec.split("/")[1]
+        return start, None if total == "*" else int(total)
+    except (ValueError, IndexError):
+        return None, None
+
+
+def get_segments(env_section):
+    """Read the number of parallel segments per download from a section of the environment file (default 1)."""
+    if "segments" in env_section and env_section["segments"]:
+        return max(1, int(env_section["segments"]))
+    return 1
+
+
+def get_hasher(checksums):
+    """
+    Return a hash object and the expected hex digest for the checksums ({algorithm: hex digest}) of a file, MD5 or
+    SHA if available, else BLAKE3 if the blake3 package is installed. Returns (None, None) if none can be verified.
+    """
+    checksums = {algorithm.upper(): value for algorithm, value in (checksums or {}).items() if value}
+    for algorithm, name in HASHLIB_ALGORITHMS.items():
+        if algorithm in checksums:
+            return hashlib.new(name), checksums[algorithm].lower()
+    if "BLAKE3" in checksums:
+        try:
+            from blake3 import blake3
+            return blake3(), checksums["BLAKE3"].lower()
+        except ImportError:
+            pass
+    return None, None
+
+
+def hash_file(path, hasher):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            hasher.update(chunk)
+
+
+def download_file(session, url, file_temp, log_path, segments=1, headers=None, timeout=600, progress=None,
+                  checksums=None):
+    """
+    Download url to file_temp, in parallel byte ranges if segments > 1 and the server supports it. Partial downloads
+    of a previous attempt are continued. See stream_to_file for the parameters, checksums are the published
+    checksums of the file ({algorithm: hex digest}, e.g. {"MD5": "..."}), verified while it is downloaded.
+    """
+    for attempt in range(CHECKSUM_ATTEMPTS):
+        hasher, expected = get_hasher(checksums)
+        if segments > 1 and hasattr(os, "pwrite"):
+            transferred = segmented_download(session, url, file_temp, log_path, segments, headers, timeout, progress)
+            if hasher is not None:
+                hash_file(file_temp, hasher)
+        else:
+            transferred = stream_to_file(session, url, file_temp, log_path, headers, timeout, progress, hasher)
+        if hasher is None or hasher.hexdigest().lower() == expected:
+            if hasher is not None:
+                log(log_path, "Checksum {} verified.".format(expected), indent=2)
+            return transferred
+        log(log_path, "Checksum mismatch (Attempt {} of {}): {} instead of {}.".format(
+            attempt + 1, CHECKSUM_ATTEMPTS, hasher.hexdigest(), expected), indent=2, level="WARNING")
+        remove_partial(file_temp)
+    raise ChecksumMismatch("Checksum of {} does not match after {} downloads.".format(url, CHECKSUM_ATTEMPTS))
+
+
+def probe_ranges(session, url, headers, timeout):
+    """Return the metadata of url if the server supports range requests on it, else None."""
+    probe_headers = dict(headers, Range="bytes=0-0")
+    with session.get(url, headers=probe_headers, stream=True, timeout=timeout) as req:
+        raise_for_status(req)
+        if req.status_code != 206 or "Content-Encoding" in req.headers:
+            return None
+        start, length = parse_content_range(req.headers.get("Content-Range", ""))
+        if start != 0 or not length:
+            return None
+        etag = req.headers.get("ETag")
+        return {"etag": None if etag and etag.startswith("W/") else etag,
+                "last_modified": req.headers.get("Last-Modified"), "length": length}
+
+
+def segmented_download(session, url, file_temp, log_path, segments, headers=None, timeout=600, progress=None):
+    """Download url to file_temp in parallel byte ranges, see download_file."""
+    headers = dict(headers) if headers else {}
+    meta = read_meta(file_temp)
+    if os.path.isfile(file_temp) and "segments" not in meta:
+        # Continue a single stream download of a previous attempt as such
+        return stream_to_file(session, url, file_temp, log_path, headers, timeout, progress)
+    if "segments" not in meta or not os.path.isfile(file_temp):
+        meta = probe_ranges(session, url, headers, timeout)
+        if meta is None:
+            log(log_path, "Server does not support range requests, downloading in a single stream.", indent=2)
+            return stream_to_file(session, url, file_temp, log_path, headers, timeout, progress)
+        size = max(-(-meta["length"] // segments), MIN_SEGMENT_SIZE)
+        meta["segments"] = [[start, min(start + size, meta["length"]) - 1, 0]
+                            for start in range(0, meta["length"], size)]
+        with open(file_temp, "wb") as f:
+            f.truncate(meta["length"])
+        write_meta(file_temp, meta)
+    else:
+        log(log_path, "Resuming segmented download at {:.1f} MB.".format(
+            sum(s[2] for s in meta["segments"]) / 2 ** 20), indent=2)
+
+    validator = get_validator(meta)
+    limiter = get_limiter(getattr(session, "backend", ""))
+    lock = Lock()
+    todo = [segment for segment in meta["segments"] if segment[0] + segment[2] <= segment[1]]
+    transferred = [0]
+    fd = os.open(file_temp, os.O_WRONLY)
+    progress_bar = tqdm(unit='B', unit_scale=True, initial=sum(s[2] for s in meta["segments"]), total=meta["length"])
+
+    def fetch(segment):
+        start, end, _ = segment
+        for attempt in range(SEGMENT_ATTEMPTS):
+            position = start + segment[2]
+            segment_headers = dict(headers, Range="bytes={}-{}".format(position, end))
+            if validator:
+                segment_headers["If-Range"] = validator
+            try:
+                with session.get(url, headers=segment_headers, stream=True, timeout=timeout) as req:
+                    raise_for_status(req)
+                    returned_start, length = parse_content_range(req.headers.get("Content-Range", ""))
+                    if req.status_code != 206 or returned_start != position or length != meta["length"]:
+                        raise RuntimeError("Remote file changed during the segmented download.")
+                    for chunk in req.iter_content(chunk_size=CHUNK_SIZE):
+                        if chunk:
+                            chunk = chunk[:end + 1 - position]
+                            os.pwrite(fd, chunk, position)
+                            position += len(chunk)
+                            limiter.transfer(len(chunk))
+                            with lock:
+                                segment[2] += len(chunk)
+                                transferred[0] += len(chunk)
+                                progress_bar.update(len(chunk))
+                            if progress is not None:
+                                progress(len(chunk))
+                if start + segment[2] > end:
+                    return
+                raise ValueError("Segment {}-{} ended at {}.".format(start, end, position))
+            except (RuntimeError, DownloadCancelled):
+                raise
+            except Exception as e:
+                log(log_path, "Segment {}-{} failed (Attempt {} of {}): {}".format(
+                    start, end, attempt + 1, SEGMENT_ATTEMPTS, e), indent=2)
+                time.sleep(2 ** attempt)
+            finally:
+                with lock:
+                    write_meta(file_temp, meta)
+        raise ValueError("Failed to download segment {}-{} after {} attempts".format(start, end, SEGMENT_ATTEMPTS))
+
+    try:
+        with ThreadPoolExecutor(max_workers=segments, thread_name_prefix="Segment") as executor:
+            errors = [future.exception() for future in [executor.submit(fetch, segment) for segment in todo]]
+    finally:
+        os.close(fd)
+        progress_bar.close()
+    for error in errors:
+        if isinstance(error, (RuntimeError, DownloadCancelled)):
+            remove_partial(file_temp)
+        if error is not None:
+            raise error
+    Path(get_meta_file(file_temp)).unlink()
+    return transferred[0]
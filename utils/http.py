@@ -0,0 +1,91 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Shared HTTP sessions of the DIAS APIs.
+
+Every backend uses one requests.Session per process, so connections (and their TLS sessions) are kept alive and
+reused between requests and products instead of being opened for every request. The connection pool of a session is
+sized for the parallel downloads of the run, and idempotent requests are retried with exponential backoff on
+connection errors and on 500, 502, 503 and 504 answers. Request specific headers (e.g. tokens) are passed per
+request, as the sessions are shared between threads.
+
+The searches of a backend share one cached session (see get_search_session), which answers repeated searches from
+a local requests_cache database for an hour.
+
+Every request of a backend passes its rate limiter (see utils.ratelimit), which also pauses the backend and repeats
+the request on 429 answers.
+"""
+
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from utils.ratelimit import get_limiter
+
+# Number of retries of a request on connection errors and retryable answers
+RETRIES = 3
+# Backoff factor of the retries, the n-th retry waits backoff * 2 ** (n - 1) seconds
+BACKOFF = 2
+# 429 answers are handled by the rate limiter of the backend, which pauses all threads. urllib3 would retry them on
+# its own if they carry a Retry-After header, so it ignores Retry-After (see mount)
+RETRY_STATUS = [500, 502, 503, 504]
+
+settings = {"pool_size": 10}
+_sessions = {}
+_search_sessions = {}
+_sessions_lock = Lock()
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """HTTPAdapter which sends the requests of a backend through its rate limiter."""
+
+    def __init__(self, name, **kwargs):
+        self.name = name
+        super(RateLimitedAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        limiter = get_limiter(self.name)
+        for attempt in range(RETRIES + 1):
+            limiter.request()
+            response = super(RateLimitedAdapter, self).send(request, **kwargs)
+            if response.status_code != 429 or attempt == RETRIES:
+                return response
+            limiter.throttled(response.headers.get("Retry-After"), attempt)
+            response.close()
+
+
+def configure_sessions(max_parallel_downloads):
+    """Size the connection pools for the number of parallel downloads (which may use several connections each)."""
+    settings["pool_size"] = max(10, 4 * max_parallel_downloads)
+
+
+def get_session(name):
+    """Return the shared session of the backend with the given name, creating it on first use."""
+    with _sessions_lock:
+        if name not in _sessions:
+            _sessions[name] = mount(requests.Session(), name)
+        return _sessions[name]
+
+
+def get_search_session(name, cache_path):
+    """Return the shared cached search session of the backend with the given name, creating it on first use."""
+    import requests_cache
+    with _sessions_lock:
+        if name not in _search_sessions:
+            _search_sessions[name] = mount(requests_cache.CachedSession(
+                cache_path, backend='sqlite', expire_after=3600, allowable_methods=('GET', 'POST')), name)
+        return _search_sessions[name]
+
+
+def mount(session, name):
+    """Mount a retrying, rate limited adapter of the backend with the given name on a session, e.g. a CachedSession."""
+    retry = Retry(total=RETRIES, backoff_factor=BACKOFF, status_forcelist=RETRY_STATUS,
+                  allowed_methods=["HEAD", "GET", "OPTIONS"], respect_retry_after_header=False, raise_on_status=False)
+    adapter = RateLimitedAdapter(name, pool_connections=4, pool_maxsize=settings["pool_size"], max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.backend = name
+    return session
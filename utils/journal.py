@@ -0,0 +1,120 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Persistent journal of a Sencast run.
+
+The journal is a SQLite database in the output folder of the run which records every download, processor, mosaic
+and adapter step together with its input, output, output size and a hash of the parameters. When a run is restarted,
+completed steps are looked up in memory and skipped without probing the file system or calling the DIAS APIs.
+"""
+
+import os
+import json
+import sqlite3
+import hashlib
+from threading import Lock
+from datetime import datetime
+
+# The name of the journal database within the output folder
+JOURNAL_FILENAME = "sencast_journal.sqlite"
+
+_journals = {}
+_journals_lock = Lock()
+
+
+def params_hash(params):
+    """Return a stable hash of all parameters of a run."""
+    content = json.dumps({section: dict(params[section]) for section in params.sections()}, sort_keys=True)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def get_journal(env):
+    """Return the journal of the current run, or None if journaling is disabled. Connections are opened once per
+    process, so the journal can be used from worker threads and worker processes."""
+    if "journal_file" not in env["General"] or not env["General"]["journal_file"]:
+        return None
+    key = (os.getpid(), env["General"]["journal_file"], env["General"]["journal_params_hash"])
+    with _journals_lock:
+        if key not in _journals:
+            _journals[key] = Journal(env["General"]["journal_file"], env["General"]["journal_params_hash"])
+        return _journals[key]
+
+
+def close_journal(path):
+    """Close and forget the journals of a file in this process, e.g. before it is removed for an overwrite run."""
+    with _journals_lock:
+        for key in [key for key in _journals if key[1] == path]:
+            _journals.pop(key).close()
+
+
+def step_key(step_type, name, group, input_file):
+    return "|".join([step_type, name, group, input_file])
+
+
+def get_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            size += os.path.getsize(os.path.join(root, file))
+    return size
+
+
+class Journal(object):
+    """SQLite backed journal with an in-memory index of the completed steps."""
+
+    def __init__(self, path, params_hash):
+        self.path = path
+        self.params_hash = params_hash
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS steps (key TEXT PRIMARY KEY, step_group TEXT, "
+                                    "type TEXT, name TEXT, input TEXT, output TEXT, size INTEGER, params_hash TEXT, "
+                                    "status TEXT, duration REAL, updated TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS searches (params_hash TEXT PRIMARY KEY, "
+                                    "products TEXT, updated TEXT)")
+        self.steps = {}
+        for key, output, status, step_hash in self.connection.execute(
+                "SELECT key, output, status, params_hash FROM steps"):
+            if status == "Succeeded" and step_hash == params_hash:
+                self.steps[key] = json.loads(output)
+
+    def completed(self, step_type, name, group, input_file):
+        """Return the recorded output of a completed step, or None if the step still has to be run."""
+        return self.steps.get(step_key(step_type, name, group, input_file))
+
+    def record(self, step_type, name, group, input_file, output, status, duration=0):
+        """Record the outcome of a step. Output can be any JSON serializable value."""
+        key = step_key(step_type, name, group, input_file)
+        size = 0
+        if isinstance(output, str) and output and os.path.exists(output):
+            size = get_size(output)
+        with self.lock:
+            with self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO steps VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                        (key, group, step_type, name, input_file, json.dumps(output), size,
+                                         self.params_hash, status, duration, datetime.now().isoformat()))
+            if status == "Succeeded":
+                self.steps[key] = output
+            else:
+                self.steps.pop(key, None)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def get_products(self):
+        """Return the product list of a previous search with the same parameters, or None."""
+        with self.lock:
+            row = self.connection.execute("SELECT products FROM searches WHERE params_hash = ?",
+                                          (self.params_hash,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_products(self, products):
+        with self.lock:
+            with self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO searches VALUES (?, ?, ?)",
+                                        (self.params_hash, json.dumps(products), datetime.now().isoformat()))
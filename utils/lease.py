@@ -0,0 +1,187 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File-system leases for distributing the product groups of one run over several Sencast instances.
+
+Instances started with the same parameter and environment files share the output folder of the run. Before running
+a group, an instance claims it by atomically creating a lease file in the Leases folder of the output folder. While
+the group runs, a heartbeat thread refreshes the modification time of the lease. A lease whose heartbeat is older
+than lease_stale_seconds is considered abandoned (e.g. the node crashed) and can be taken over. Takeovers are
+serialised by an exclusively created takeover file, so only one instance replaces a stale lease, and only after
+checking again that it is still stale. An instance which finds that its lease was taken over stops the group (see
+has_lost_lease). Groups which completed without failures are marked with a done file and skipped by all instances.
+"""
+
+import os
+import re
+import time
+import uuid
+import socket
+from threading import Thread, Event, Lock
+from datetime import datetime
+
+from utils.auxil import log
+
+# The name of the folder within the output folder holding the leases
+LEASE_DIR = "Leases"
+# Default age in seconds of the last heartbeat after which a lease is considered abandoned
+DEFAULT_STALE_SECONDS = 600
+# Default interval of the heartbeat in seconds
+DEFAULT_HEARTBEAT_SECONDS = 60
+
+# Identifies this instance in the lease files
+WORKER_ID = "{}-{}-{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+_leases = {}
+_lost_groups = set()
+_leases_lock = Lock()
+_heartbeat = {"thread": None, "pid": None, "stop": Event()}
+
+
+def is_distributed(env):
+    return "distributed" in env["General"] and env["General"]["distributed"].lower() == "true"
+
+
+def get_lease_files(l2_path, group):
+    name = re.sub(r"[^\w.-]", "_", group)
+    folder = os.path.join(l2_path, LEASE_DIR)
+    return os.path.join(folder, name + ".lease"), os.path.join(folder, name + ".done")
+
+
+def is_stale(path, stale_seconds):
+    """Check if the last heartbeat of a lease (or takeover) file is older than stale_seconds."""
+    try:
+        return time.time() - os.path.getmtime(path) > stale_seconds
+    except FileNotFoundError:
+        return False
+
+
+def create_lease(lease_file):
+    """Exclusively create a lease file owned by this instance, raises FileExistsError if it exists."""
+    fd = os.open(lease_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    with os.fdopen(fd, "w", encoding="utf-8") as handle:
+        handle.write("worker={}\n".format(WORKER_ID))
+        handle.write("created_utc={}\n".format(datetime.utcnow().isoformat()))
+
+
+def take_over_lease(lease_file, stale_seconds):
+    """
+    Replace a stale lease by one of this instance. Returns False if another instance is taking it over or the lease
+    was refreshed in the meantime.
+    """
+    takeover_file = lease_file + ".takeover"
+    if is_stale(takeover_file, stale_seconds):
+        # Left by an instance which crashed during a takeover
+        try:
+            os.remove(takeover_file)
+        except FileNotFoundError:
+            pass
+    try:
+        os.close(os.open(takeover_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return False
+    try:
+        # The lease may have been replaced or refreshed since it was found stale
+        if os.path.exists(lease_file) and not is_stale(lease_file, stale_seconds):
+            return False
+        try:
+            os.remove(lease_file)
+        except FileNotFoundError:
+            pass
+        try:
+            create_lease(lease_file)
+        except FileExistsError:
+            # Claimed by an instance which found the group unclaimed after the removal
+            return False
+        return True
+    finally:
+        os.remove(takeover_file)
+
+
+def acquire_group_lease(env, l2_path, group):
+    """Claim a group for this instance. Returns the lease file, or None if the group is done or claimed elsewhere."""
+    lease_file, done_file = get_lease_files(l2_path, group)
+    os.makedirs(os.path.dirname(lease_file), exist_ok=True)
+    stale_seconds = int(env["General"]["lease_stale_seconds"]) if "lease_stale_seconds" in env["General"] and \
+        env["General"]["lease_stale_seconds"] else DEFAULT_STALE_SECONDS
+    while True:
+        if os.path.exists(done_file):
+            log(env["General"]["log"], "Group {} was completed by another worker.".format(group))
+            return None
+        try:
+            create_lease(lease_file)
+            break
+        except FileExistsError:
+            try:
+                age = time.time() - os.path.getmtime(lease_file)
+            except FileNotFoundError:
+                continue
+            if age <= stale_seconds or not take_over_lease(lease_file, stale_seconds):
+                log(env["General"]["log"], "Group {} is claimed by another worker.".format(group))
+                return None
+            log(env["General"]["log"], "Took over stale lease of group {} after {:.0f}s without heartbeat."
+                .format(group, age))
+            break
+    log(env["General"]["log"], "Claimed group {} as worker {}.".format(group, WORKER_ID))
+    heartbeat_seconds = int(env["General"]["lease_heartbeat_seconds"]) if "lease_heartbeat_seconds" in \
+        env["General"] and env["General"]["lease_heartbeat_seconds"] else DEFAULT_HEARTBEAT_SECONDS
+    with _leases_lock:
+        _leases[lease_file] = (env["General"]["log"], group)
+        _lost_groups.discard(group)
+    start_heartbeat(heartbeat_seconds)
+    return lease_file
+
+
+def has_lost_lease(group):
+    """Check if the lease of a group run by this instance was taken over by another instance."""
+    with _leases_lock:
+        return group in _lost_groups
+
+
+def release_group_lease(lease_file, done):
+    """Release a lease, marking the group as done if it completed (and this instance still owns the lease)."""
+    with _leases_lock:
+        _leases.pop(lease_file, None)
+    if done and is_lease_owner(lease_file):
+        with open(lease_file[:-len(".lease")] + ".done", "w") as f:
+            f.write("worker={}\ncompleted_utc={}\n".format(WORKER_ID, datetime.utcnow().isoformat()))
+    try:
+        if is_lease_owner(lease_file):
+            os.remove(lease_file)
+    except FileNotFoundError:
+        pass
+
+
+def is_lease_owner(lease_file):
+    try:
+        with open(lease_file, "r", encoding="utf-8") as f:
+            return "worker={}\n".format(WORKER_ID) in f.read()
+    except FileNotFoundError:
+        return False
+
+
+def start_heartbeat(interval):
+    if _heartbeat["pid"] == os.getpid() and _heartbeat["thread"].is_alive():
+        return
+    _heartbeat["pid"] = os.getpid()
+    _heartbeat["thread"] = Thread(target=heartbeat, args=(interval,), name="LeaseHeartbeat", daemon=True)
+    _heartbeat["thread"].start()
+
+
+def heartbeat(interval):
+    while not _heartbeat["stop"].wait(interval):
+        with _leases_lock:
+            leases = list(_leases.items())
+        for lease_file, (log_file, group) in leases:
+            try:
+                if is_lease_owner(lease_file):
+                    os.utime(lease_file)
+                else:
+                    log(log_file, "Lost lease {} to another worker, stopping group {}.".format(lease_file, group),
+                        level="ERROR")
+                    with _leases_lock:
+                        _leases.pop(lease_file, None)
+                        _lost_groups.add(group)
+            except OSError as e:
+                log(log_file, "WARNING failed to refresh lease {}: {}".format(lease_file, e), level="WARNING")
@@ -0,0 +1,108 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Asynchronous logging backend of Sencast.
+
+utils.auxil.log only formats the line and puts it on an in-memory queue. A single background writer thread per
+process writes the queued lines in batches, opening every log file once per batch, and echoes them to stdout.
+Optionally the lines are also written as JSON lines and to one log file per product group, and lines below the
+configured log level are dropped. The writer is started lazily in every process, so it also works in forked worker
+processes.
+"""
+
+import os
+import re
+import json
+import queue
+import atexit
+from threading import Thread, Lock, current_thread, local
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+
+settings = {"level": LEVELS["INFO"], "json": False, "groups": False}
+
+_writer = {"pid": None, "queue": None, "thread": None}
+_writer_lock = Lock()
+_context = local()
+
+
+def configure_logging(env):
+    """Read the log_level, log_json and log_groups settings from the General section of the environment."""
+    general = env["General"]
+    if "log_level" in general and general["log_level"]:
+        settings["level"] = LEVELS[general["log_level"].upper()]
+    settings["json"] = "log_json" in general and general["log_json"].lower() == "true"
+    settings["groups"] = "log_groups" in general and general["log_groups"].lower() == "true"
+
+
+def set_log_group(group):
+    """Set the product group of the current thread, used for the per-group log files."""
+    _context.group = group
+
+
+def get_log_group():
+    return getattr(_context, "group", None)
+
+
+def enqueue(file, timestamp, out, level="INFO", indent=0, text=""):
+    """Queue a formatted line for the writer thread."""
+    if LEVELS.get(level, LEVELS["INFO"]) < settings["level"]:
+        return
+    get_queue().put((file, timestamp, out, level, indent, text, get_log_group(), current_thread().name))
+
+
+def get_queue():
+    pid = os.getpid()
+    if _writer["pid"] != pid:
+        with _writer_lock:
+            if _writer["pid"] != pid:
+                _writer["queue"] = queue.Queue()
+                _writer["thread"] = Thread(target=_write, args=(_writer["queue"],), name="LogWriter", daemon=True)
+                _writer["thread"].start()
+                _writer["pid"] = pid
+    return _writer["queue"]
+
+
+def flush_logs():
+    """Block until all queued lines of this process are written."""
+    if _writer["pid"] == os.getpid():
+        _writer["queue"].join()
+
+
+def group_log_file(file, group):
+    base, ext = os.path.splitext(file)
+    return "{}_{}{}".format(base, re.sub(r"[^\w.-]", "_", group), ext)
+
+
+def _write(records):
+    while True:
+        batch = [records.get()]
+        while True:
+            try:
+                batch.append(records.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            lines = {}
+            for file, timestamp, out, level, indent, text, group, thread in batch:
+                print(out)
+                lines.setdefault(file, []).append(out + "\n")
+                if settings["groups"] and group:
+                    lines.setdefault(group_log_file(file, group), []).append(out + "\n")
+                if settings["json"]:
+                    lines.setdefault(os.path.splitext(file)[0] + ".jsonl", []).append(json.dumps(
+                        {"time": timestamp, "level": level, "group": group, "thread": thread, "indent": indent,
+                         "message": text}) + "\n")
+            # The files are closed after every batch, so that no handles are left open for finished groups or jobs
+            for file, content in lines.items():
+                with open(file, "a") as f:
+                    f.write("".join(content))
+        except Exception as e:
+            print("Failed to write log: {}".format(e))
+        finally:
+            for _ in batch:
+                records.task_done()
+
+
+atexit.register(flush_logs)
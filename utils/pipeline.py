@@ -0,0 +1,154 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Stage scheduler used by Sencast to overlap the download, processing and adapter stages of different product groups.
+
+Every stage is served by its own pool of worker threads and stages are connected by bounded queues. Items (product
+groups) are admitted into the first stage only while the "ahead" budget allows it, this budget is released once an
+item has passed the stage named by release_stage. This way downloads can run ahead of processing without filling the
+disk with products that will not be processed for hours.
+
+Within a group, run_graph executes the processor chain as a dependency graph of (processor, product) nodes.
+"""
+
+import queue
+import traceback
+from threading import Condition, Thread
+
+from utils.auxil import log
+from utils.resources import Budget
+
+
+class StagePipeline(object):
+    """
+    Runs items through a sequence of stages.
+
+    Parameters
+    ----------
+
+    stages
+        List of (name, function, workers) tuples. Each function is called with the item and must return the item
+        to pass on to the next stage, or None to drop the item (e.g. after a failure).
+    log_file
+        Log file to report failures of the scheduler itself
+    max_ahead
+        | **Default: None**
+        | Maximum summed weight of the items admitted but not yet past release_stage. None for no limit.
+    weight
+        | **Default: None**
+        | Function returning the weight of an item for the ahead budget, by default every item weighs 1
+    release_stage
+        | **Default: None**
+        | Name of the stage after which the weight of an item is returned to the ahead budget, defaults to the
+        | last stage
+    queue_size
+        | **Default: 1**
+        | Size of the bounded queue in front of every stage after the first one
+    """
+
+    def __init__(self, stages, log_file, max_ahead=None, weight=None, release_stage=None, queue_size=1):
+        self.stages = stages
+        self.log_file = log_file
+        self.budget = Budget(max_ahead) if max_ahead else None
+        self.weight = weight if weight else lambda item: 1
+        self.release_index = [s[0] for s in stages].index(release_stage) if release_stage else len(stages) - 1
+        self.queues = [queue.Queue(maxsize=0 if i == 0 else queue_size) for i in range(len(stages))]
+
+    def run(self, items):
+        workers = []
+        for index, (name, function, count) in enumerate(self.stages):
+            threads = [Thread(target=self._work, args=(index,), name="{}-{}".format(name, i)) for i in range(count)]
+            for thread in threads:
+                thread.start()
+            workers.append(threads)
+
+        for item in items:
+            if self.budget is not None:
+                self.budget.acquire(self.weight(item))
+            self.queues[0].put(item)
+
+        # Shut the stages down one after the other, so every stage drains before its successor stops
+        for index, threads in enumerate(workers):
+            for _ in threads:
+                self.queues[index].put(None)
+            for thread in threads:
+                thread.join()
+
+    def _work(self, index):
+        name, function, _ = self.stages[index]
+        while True:
+            item = self.queues[index].get()
+            if item is None:
+                return
+            weight = self.weight(item)
+            try:
+                result = function(item)
+            except Exception:
+                log(self.log_file, "Stage {} failed unexpectedly.".format(name))
+                log(self.log_file, traceback.format_exc(), indent=1)
+                result = None
+            if self.budget is not None and (index == self.release_index or (result is None and index < self.release_index)):
+                self.budget.release(weight)
+            if result is not None and index + 1 < len(self.stages):
+                self.queues[index + 1].put(result)
+
+
+def run_graph(nodes, function, workers, log_file, priority=None):
+    """
+    Run function(node) for every node of a dependency graph with a pool of worker threads. A node is started once all
+    of its dependencies have finished, whatever their outcome. Among the ready nodes the one with the lowest
+    priority is started first, so a single worker runs the nodes in priority order.
+
+    Parameters
+    ----------
+
+    nodes
+        Dictionary of the dependencies (list of nodes) of every node
+    function
+        Function to call for every node
+    workers
+        Number of worker threads
+    log_file
+        Log file to report unexpected failures
+    priority
+        | **Default: None**
+        | Function returning a sortable priority for a node
+    """
+    priority = priority if priority else lambda node: 0
+    remaining = {node: len(set(dependencies)) for node, dependencies in nodes.items()}
+    dependents = {node: [] for node in nodes}
+    for node, dependencies in nodes.items():
+        for dependency in set(dependencies):
+            dependents[dependency].append(node)
+    ready = [node for node, count in remaining.items() if count == 0]
+    state = {"unfinished": len(nodes)}
+    condition = Condition()
+
+    def work():
+        while True:
+            with condition:
+                while not ready and state["unfinished"] > 0:
+                    condition.wait()
+                if state["unfinished"] == 0:
+                    return
+                ready.sort(key=priority)
+                node = ready.pop(0)
+            try:
+                function(node)
+            except Exception:
+                log(log_file, "Graph node {} failed unexpectedly.".format(node))
+                log(log_file, traceback.format_exc(), indent=1)
+            with condition:
+                state["unfinished"] -= 1
+                for dependent in dependents[node]:
+                    remaining[dependent] -= 1
+                    if remaining[dependent] == 0:
+                        ready.append(dependent)
+                condition.notify_all()
+
+    threads = [Thread(target=work, name="Graph-{}".format(i)) for i in range(max(1, min(workers, len(nodes))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
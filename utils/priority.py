@@ -0,0 +1,129 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Prioritised downloads.
+
+With download_order in the General section of the environment file, the products waiting for a download slot are
+served in the order of a policy instead of the order in which their threads reached the slot, and the groups are
+started in this order:
+
+- chronological: the newest products first, for near-real-time processing
+- smallest: the smallest products first, so that processing can start as early as possible
+- complete_groups: the products of the group with the fewest bytes left to download first, so that groups become
+  processable one after the other
+
+Product sizes are taken from the search results (the OData ContentLength), products of unknown size count as 0.
+"""
+
+import heapq
+import itertools
+from threading import Condition
+from datetime import datetime
+
+DOWNLOAD_ORDERS = ["chronological", "smallest", "complete_groups"]
+
+
+def get_download_order(env):
+    """Return the download_order policy of the environment, None for the default order."""
+    if "download_order" not in env["General"] or not env["General"]["download_order"]:
+        return None
+    order = env["General"]["download_order"].strip().lower()
+    if order not in DOWNLOAD_ORDERS:
+        raise ValueError("Unknown download_order {}, must be one of: {}".format(order, ", ".join(DOWNLOAD_ORDERS)))
+    return order
+
+
+def get_timestamp(product):
+    return datetime.fromisoformat(product["sensing_start"].replace("Z", "")).timestamp()
+
+
+def download_priority(order, product, remaining_bytes):
+    """
+    Return the priority of a product download, lower is earlier.
+
+    Parameters
+    ----------
+
+    order
+        Policy, see get_download_order
+    product
+        The product to download
+    remaining_bytes
+        The bytes still to download for the group of the product
+    """
+    if order == "chronological":
+        return -get_timestamp(product), product["name"]
+    if order == "smallest":
+        return product.get("size") or 0, product["name"]
+    if order == "complete_groups":
+        return remaining_bytes, product["sensing_start"], product["name"]
+    return ()
+
+
+def sort_groups(product_groups, order):
+    """Return the product groups (a dictionary) in the order in which they should be started."""
+    if order is None:
+        return product_groups
+
+    def key(group):
+        products = product_groups[group]
+        if order == "chronological":
+            return -max(get_timestamp(p) for p in products), group
+        return sum(p.get("size") or 0 for p in products), group
+    return {group: product_groups[group] for group in sorted(product_groups, key=key)}
+
+
+class PrioritySemaphore(object):
+    """Semaphore which lets the waiting thread with the lowest priority through first, in turn for equal ones."""
+
+    def __init__(self, value=1):
+        self.value = value
+        self.condition = Condition()
+        self.waiting = []
+        self.counter = itertools.count()
+
+    def acquire(self, priority=()):
+        with self.condition:
+            entry = (priority, next(self.counter))
+            heapq.heappush(self.waiting, entry)
+            self.condition.wait_for(lambda: self.value > 0 and self.waiting[0] == entry)
+            heapq.heappop(self.waiting)
+            self.value -= 1
+            # Another slot may be free for the next waiter
+            self.condition.notify_all()
+
+    def release(self):
+        with self.condition:
+            self.value += 1
+            self.condition.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def priority(self, priority):
+        """Return a context acquiring the semaphore with the given priority."""
+        return PriorityContext(self, priority)
+
+
+class PriorityContext(object):
+
+    def __init__(self, semaphore, priority):
+        self.semaphore = semaphore
+        self.priority = priority
+
+    def __enter__(self):
+        self.semaphore.acquire(self.priority)
+        return self
+
+    def __exit__(self, *args):
+        self.semaphore.release()
+
+
+def prioritized(semaphore, priority):
+    """Acquire a semaphore with a priority if it supports them (process pool semaphores do not)."""
+    return semaphore.priority(priority) if isinstance(semaphore, PrioritySemaphore) else semaphore
@@ -0,0 +1,176 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Hedged ("race") search and download across the configured OData backends.
+
+With race=True in the DIAS section of the environment file, searches query all backends concurrently and merge their
+products. A download starts on the first backend, and the next backend is started as well when the running downloads
+did not deliver race_min_mb MB within race_delay_seconds of the last start, or when all of them failed. The first
+backend which completes its download claims the product, the downloads of the other backends are cancelled at their
+next chunk and remove their partial files.
+
+Every backend of a race downloads to its own temporary file (see get_temp_path), the backend and its progress are
+passed to do_download in the "race" entry of a copy of the product.
+"""
+
+import time
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from utils.auxil import log
+from utils.breaker import get_breaker, wait_for_backend
+from utils.download import DownloadCancelled
+
+# Default seconds after which a download which did not deliver race_min_mb MB is hedged on the next backend
+DEFAULT_DELAY_SECONDS = 60
+# Default MB a download has to deliver within race_delay_seconds
+DEFAULT_MIN_MB = 50
+# Seconds between two checks of the running downloads
+POLL_SECONDS = 1
+
+
+class RaceLost(DownloadCancelled):
+    """Raised in the download of a backend after another backend claimed the product."""
+
+
+class Contestant(object):
+    """The download of a product by one backend of a race."""
+
+    def __init__(self, race, name):
+        self.race = race
+        self.name = name
+        self.bytes = 0
+
+    def update(self, size):
+        """Count size downloaded bytes, raise RaceLost if another backend claimed the product."""
+        self.bytes += size
+        self.check()
+
+    def check(self):
+        if self.race.winner not in (None, self):
+            raise RaceLost("Download via {} cancelled, {} was faster.".format(self.name, self.race.winner.name))
+
+    def claim(self):
+        """Claim the product for this backend, raise RaceLost if another backend claimed it first."""
+        with self.race.lock:
+            if self.race.winner is None:
+                self.race.winner = self
+        self.check()
+
+
+class Race(object):
+    """The downloads of one product by several backends, of which the first to complete wins."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.winner = None
+
+
+def is_race(env):
+    return "race" in env["DIAS"] and env["DIAS"]["race"].lower() == "true"
+
+
+def get_temp_path(product):
+    """Return the temporary download path of a product, separate for every backend of a race."""
+    contestant = product.get("race")
+    if contestant is None:
+        return "{}.incomplete".format(product["l1_product_path"])
+    return "{}.{}.incomplete".format(product["l1_product_path"], contestant.name.lower())
+
+
+def get_progress(product):
+    """Return the progress function of a racing download for download_file, None outside of a race."""
+    contestant = product.get("race")
+    return None if contestant is None else contestant.update
+
+
+def check(product):
+    """Raise RaceLost if the product is raced and was claimed by another backend."""
+    if product.get("race") is not None:
+        product["race"].check()
+
+
+def claim(product):
+    """Claim a raced product after its download completed, before it is moved or extracted to its final path."""
+    if product.get("race") is not None:
+        product["race"].claim()
+
+
+def race_search(env, download_backends, start, end, sensor, resolution, wkt):
+    """
+    Search all backends concurrently and merge their products by name, preferring the products of earlier backends.
+    Returns the names of the backends which answered and the products, raises a ValueError if no backend answered.
+    """
+    def search(backend):
+        try:
+            return backend["get_download_requests"](backend["auth"], start, end, sensor, resolution, wkt, env)
+        except Exception as e:
+            log(env["General"]["log"], "FAILED to list products from {}: {}".format(backend["name"], e),
+                level="ERROR")
+            return None
+
+    log(env["General"]["log"], "Searching {} concurrently.".format(", ".join(b["name"] for b in download_backends)))
+    with ThreadPoolExecutor(max_workers=len(download_backends), thread_name_prefix="Race") as executor:
+        results = list(executor.map(search, download_backends))
+    if all(result is None for result in results):
+        raise ValueError("Unable to list products from any configured API")
+
+    products, names = {}, []
+    for backend, result in zip(download_backends, results):
+        if result is None:
+            continue
+        names.append(backend["name"])
+        for product in result:
+            products.setdefault(product["name"], product)
+    log(env["General"]["log"], "Found {} products from {}.".format(len(products), ", ".join(names)))
+    return "+".join(names), sorted(products.values(), key=lambda p: p["sensing_start"])
+
+
+def race_download(env, download_backends, product):
+    """
+    Download a product from the first backend, hedging it on the next backends when it is slow or fails. Returns the
+    name of the backend which won, raises a ValueError if the download failed on all backends.
+    """
+    delay = float(env["DIAS"]["race_delay_seconds"]) if "race_delay_seconds" in env["DIAS"] and \
+        env["DIAS"]["race_delay_seconds"] else DEFAULT_DELAY_SECONDS
+    min_bytes = float(env["DIAS"]["race_min_mb"]) * 2 ** 20 if "race_min_mb" in env["DIAS"] and \
+        env["DIAS"]["race_min_mb"] else DEFAULT_MIN_MB * 2 ** 20
+    race = Race()
+    wait_for_backend([get_breaker(backend["name"], env) for backend in download_backends], env["General"]["log"])
+    pending = [backend for backend in download_backends if get_breaker(backend["name"], env).available()]
+    running = {}
+    started = 0
+    errors = []
+    executor = ThreadPoolExecutor(max_workers=len(download_backends), thread_name_prefix="Race")
+    try:
+        while True:
+            if pending and (not running or (time.time() - started >= delay and
+                                            all(c.bytes < min_bytes for c in running.values()))):
+                backend = pending.pop(0)
+                if running:
+                    log(env["General"]["log"], "Download via {} delivered {:.1f} MB in {:.0f} s, racing {}.".format(
+                        ", ".join(running[future].name for future in running),
+                        sum(c.bytes for c in running.values()) / 2 ** 20, time.time() - started, backend["name"]),
+                        indent=1)
+                else:
+                    log(env["General"]["log"], "Attempting download via {}".format(backend["name"]), indent=1)
+                contestant = Contestant(race, backend["name"])
+                future = executor.submit(backend["do_download"], backend["auth"], dict(product, race=contestant), env)
+                running[future] = contestant
+                started = time.time()
+            if not running:
+                raise ValueError("Download failed on all APIs: {}".format("; ".join(errors)))
+            done, _ = wait(list(running), timeout=POLL_SECONDS, return_when=FIRST_COMPLETED)
+            for future in done:
+                contestant = running.pop(future)
+                if future.exception() is None:
+                    contestant.claim()
+                    log(env["General"]["log"], "Download via {} won the race.".format(contestant.name), indent=1)
+                    return contestant.name
+                errors.append("{}: {}".format(contestant.name, future.exception()))
+                log(env["General"]["log"], "Download via {} failed: {}".format(contestant.name, future.exception()),
+                    indent=1, level="WARNING")
+    finally:
+        # The losing downloads notice the claim at their next chunk and clean up in the background
+        executor.shutdown(wait=False)
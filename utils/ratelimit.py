@@ -0,0 +1,144 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Process-wide request and bandwidth limits of the DIAS APIs.
+
+Every backend has one token bucket for its requests per second and one for its downloaded bytes per second, shared by
+all threads of the process. They are configured with max_requests_per_second and max_mb_per_second in the section of
+the API in the environment file, without a limit if not set. The shared HTTP sessions (see utils.http) take a request
+token before every request, downloads take byte tokens for every chunk.
+
+When an API answers 429 Too Many Requests, all requests to it are paused for the Retry-After time of the answer (or
+an exponential backoff if it has none) before the request is repeated.
+"""
+
+import time
+from threading import Lock
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from utils.auxil import log
+
+# Seconds of the first pause after a 429 answer without Retry-After, doubled for every further 429 of a request
+BACKOFF = 5
+# Longest pause after a 429 answer
+MAX_PAUSE = 600
+
+settings = {"log": None}
+_limiters = {}
+_limiters_lock = Lock()
+
+
+class TokenBucket(object):
+    """
+    Token bucket refilled with rate tokens per second up to capacity tokens (default: one second of tokens).
+    A caller reserves its tokens and waits for the ones not yet available, so callers are served in turn.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity else self.rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def consume(self, amount=1):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class RateLimiter(object):
+    """
+    Request and bandwidth limits of one backend.
+
+    Parameters
+    ----------
+
+    name
+        Name of the backend, for the log
+    requests_per_second
+        | **Default: None**
+        | Maximum requests per second, None for no limit
+    bytes_per_second
+        | **Default: None**
+        | Maximum downloaded bytes per second, None for no limit
+    """
+
+    def __init__(self, name, requests_per_second=None, bytes_per_second=None):
+        self.name = name
+        self.requests = TokenBucket(requests_per_second) if requests_per_second else None
+        self.bytes = TokenBucket(bytes_per_second) if bytes_per_second else None
+        self.paused_until = 0
+        self.lock = Lock()
+
+    def request(self):
+        """Wait until a request may be sent."""
+        while True:
+            with self.lock:
+                pause = self.paused_until - time.time()
+            if pause <= 0:
+                break
+            time.sleep(pause)
+        if self.requests is not None:
+            self.requests.consume()
+
+    def transfer(self, size):
+        """Wait until size more bytes may be downloaded."""
+        if self.bytes is not None:
+            self.bytes.consume(size)
+
+    def throttled(self, retry_after, attempt):
+        """Pause all requests after a 429 answer, for its Retry-After header or an exponential backoff."""
+        pause = min(MAX_PAUSE, parse_retry_after(retry_after) or BACKOFF * 2 ** attempt)
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + pause)
+        if settings["log"]:
+            log(settings["log"], "{} answered 429 Too Many Requests, pausing its requests for {:.0f} s.".format(
+                self.name, pause), indent=2, level="WARNING")
+        return pause
+
+
+def parse_retry_after(retry_after):
+    """Return the seconds of a Retry-After header (seconds or an HTTP date), None if it is missing or invalid."""
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def configure_rate_limits(env):
+    """Create the limiters of all APIs with max_requests_per_second or max_mb_per_second in their section."""
+    settings["log"] = env["General"]["log"]
+    with _limiters_lock:
+        _limiters.clear()
+        for name in env.sections():
+            section = env[name]
+            rps = float(section["max_requests_per_second"]) if "max_requests_per_second" in section and \
+                section["max_requests_per_second"] else None
+            mbps = float(section["max_mb_per_second"]) if "max_mb_per_second" in section and \
+                section["max_mb_per_second"] else None
+            if rps or mbps:
+                log(env["General"]["log"], "Limiting {} to {} requests/s and {} MB/s.".format(
+                    name, rps or "unlimited", mbps or "unlimited"))
+                _limiters[name] = RateLimiter(name, rps, mbps * 2 ** 20 if mbps else None)
+
+
+def get_limiter(name):
+    """Return the limiter of a backend, one without limits (but pausing on 429 answers) if none is configured."""
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = RateLimiter(name)
+        return _limiters[name]
@@ -0,0 +1,133 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Memory admission control for Sencast.
+
+When memory_budget is set in the environment file, every GPT call reserves its JVM heap (max_memory) and every
+in-process processor reserves its estimated array size from one budget, and only starts once the reservation fits.
+This avoids starting more GPT processes than the machine can hold, which get killed by the kernel otherwise.
+With executor=process the budget is held by the manager of the worker pool and shared by all worker processes.
+"""
+
+import os
+import time
+import contextlib
+from threading import Condition, local
+
+from utils.auxil import log
+
+_budget = None
+_gpt_memory = 0
+_local = local()
+
+
+class Budget(object):
+    """Counting budget which blocks until the requested amount is available.
+
+    A request larger than the whole capacity is admitted as soon as nothing else is in flight, so that a single
+    large item can never dead-lock the scheduler."""
+
+    def __init__(self, capacity, manager=None):
+        self.capacity = capacity
+        self.condition = manager.Condition() if manager else Condition()
+        self.shared = manager.Value("i", 0) if manager else None
+        self.local_used = 0
+
+    @property
+    def used(self):
+        return self.shared.value if self.shared is not None else self.local_used
+
+    @used.setter
+    def used(self, value):
+        if self.shared is not None:
+            self.shared.value = value
+        else:
+            self.local_used = value
+
+    def acquire(self, amount):
+        with self.condition:
+            while self.used > 0 and self.used + amount > self.capacity:
+                self.condition.wait()
+            self.used += amount
+
+    def release(self, amount):
+        with self.condition:
+            self.used -= amount
+            self.condition.notify_all()
+
+
+def parse_memory(value):
+    """Convert a memory size such as 4096m, 4G or 4g (as used for -Xmx) to megabytes."""
+    value = str(value).strip()
+    if value[-1] in "mM":
+        return int(float(value[:-1]))
+    elif value[-1] in "gG":
+        return int(float(value[:-1]) * 1024)
+    elif value.isdigit():
+        return int(value)
+    raise RuntimeError("Unrecognised memory size: {}".format(value))
+
+
+def configure_memory_budget(env):
+    """Set up the memory budget of this process from the memory_budget and max_memory settings of the environment."""
+    global _budget, _gpt_memory
+    if "memory_budget" in env["General"] and env["General"]["memory_budget"]:
+        _gpt_memory = parse_memory(env["General"]["max_memory"]) if env["General"]["max_memory"] else 0
+        _budget = Budget(parse_memory(env["General"]["memory_budget"]))
+        log(env["General"]["log"], "Memory budget: {}MB, GPT heap: {}MB".format(_budget.capacity, _gpt_memory),
+            indent=1)
+    else:
+        _budget, _gpt_memory = None, 0
+
+
+def share_memory_budget(manager):
+    """Move the budget of this process to a multiprocessing manager and return it, for use_memory_budget."""
+    global _budget
+    if _budget is not None:
+        _budget = Budget(_budget.capacity, manager)
+    return _budget
+
+
+def use_memory_budget(budget):
+    """Use a budget shared by share_memory_budget in a worker process."""
+    global _budget
+    _budget = budget
+
+
+def gpt_memory():
+    """Return the heap size of one GPT process in megabytes."""
+    return _gpt_memory
+
+
+@contextlib.contextmanager
+def reserve_memory(amount, log_path=None, label="", indent=1):
+    """
+    Reserve amount megabytes of the memory budget for the duration of the context. Reservations are not nested:
+    while a thread holds a reservation, further reservations of the same thread (e.g. the GPT call of a processor
+    which declared its footprint including the GPT heap) are admitted immediately.
+    """
+    if _budget is None or amount <= 0 or getattr(_local, "reserved", False):
+        yield
+        return
+    start = time.time()
+    _budget.acquire(amount)
+    waited = time.time() - start
+    if log_path and waited > 1:
+        log(log_path, "{} waited {:.1f}s for {}MB of the memory budget.".format(label, waited, amount), indent=indent)
+    _local.reserved = True
+    try:
+        yield
+    finally:
+        _local.reserved = False
+        _budget.release(amount)
+
+
+def estimate_nc_memory(path):
+    """Estimate the memory in megabytes needed to hold all raster bands of a NetCDF product as float64 arrays."""
+    from netCDF4 import Dataset
+    if not os.path.isfile(path):
+        return 0
+    with Dataset(path) as nc:
+        cells = sum(nc.variables[var].size for var in nc.variables if len(nc.variables[var].shape) >= 2)
+    return int(cells * 8 / 1e6)
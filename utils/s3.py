@@ -0,0 +1,129 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Concurrent S3 downloads for the DIAS APIs.
+
+The S3 clients are created once per endpoint and credentials and shared by all download threads. The objects of a
+product are fetched by a bounded thread pool, large objects (e.g. JP2 images) in multipart ranges. Objects which were
+already completely downloaded by a previous attempt are skipped.
+"""
+
+import os
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.auxil import log
+from utils.download import DownloadCancelled
+
+# Default number of objects downloaded in parallel per product
+DEFAULT_WORKERS = 8
+# Objects larger than this are downloaded in multipart ranges
+MULTIPART_THRESHOLD = 32 * 2 ** 20
+MULTIPART_CHUNKSIZE = 16 * 2 ** 20
+
+_clients = {}
+_clients_lock = Lock()
+
+
+def get_workers(env_section):
+    """Read the number of parallel object downloads from a section of the environment file."""
+    if "s3_workers" in env_section and env_section["s3_workers"]:
+        return max(1, int(env_section["s3_workers"]))
+    return DEFAULT_WORKERS
+
+
+def get_client(access_key, secret_key, endpoint_url=None, region_name=None, workers=DEFAULT_WORKERS):
+    """Return the shared S3 client for the given endpoint and credentials, boto3 clients are thread safe."""
+    import boto3
+    from botocore.config import Config
+    key = (access_key, secret_key, endpoint_url, region_name)
+    with _clients_lock:
+        if key not in _clients:
+            # Every worker may use up to 4 connections for the parts of a multipart download
+            config = Config(max_pool_connections=max(10, workers * 4), retries={"max_attempts": 5, "mode": "standard"})
+            _clients[key] = boto3.client("s3", aws_access_key_id=access_key, aws_secret_access_key=secret_key,
+                                         endpoint_url=endpoint_url, region_name=region_name, config=config)
+        return _clients[key]
+
+
+def list_objects(client, bucket, prefix, extra_args=None):
+    """Return the keys and sizes of all objects (no folder markers) below prefix, following the pagination."""
+    objects = []
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, **(extra_args if extra_args else {})):
+        for obj in page.get("Contents", []):
+            if not obj["Key"].endswith("/"):
+                objects.append({"Key": obj["Key"], "Size": obj["Size"]})
+    return objects
+
+
+def download_objects(client, bucket, objects, local_path, log_path, workers=DEFAULT_WORKERS, extra_args=None,
+                     progress=None):
+    """
+    Download S3 objects in parallel, skipping the ones which are already complete.
+
+    Parameters
+    ----------
+
+    client
+        S3 client, see get_client
+    bucket
+        Name of the bucket
+    objects
+        List of objects ({"Key", "Size"}) as returned by list_objects
+    local_path
+        Function returning the local path of an object key
+    log_path
+        Log file
+    workers
+        | **Default: 8**
+        | Number of objects downloaded in parallel
+    extra_args
+        | **Default: None**
+        | Extra arguments of the requests, e.g. {"RequestPayer": "requester"}
+    progress
+        | **Default: None**
+        | Function called with the size of every received chunk (e.g. of a race), which may raise DownloadCancelled
+
+    Returns
+    -------
+    The number of bytes downloaded
+    """
+    from boto3.s3.transfer import TransferConfig
+    transfer_config = TransferConfig(multipart_threshold=MULTIPART_THRESHOLD, multipart_chunksize=MULTIPART_CHUNKSIZE,
+                                     max_concurrency=4)
+    todo = []
+    for obj in objects:
+        path = local_path(obj["Key"])
+        # download_file writes to a temporary file first, so a file of the right size is complete
+        if os.path.isfile(path) and os.path.getsize(path) == obj["Size"]:
+            continue
+        todo.append((obj, path))
+    if len(todo) < len(objects):
+        log(log_path, "{} of {} objects were already downloaded.".format(len(objects) - len(todo), len(objects)),
+            indent=2)
+
+    def fetch(item):
+        obj, path = item
+        if progress is not None:
+            # Objects which did not start yet are not started once the download is cancelled
+            progress(0)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        client.download_file(bucket, obj["Key"], path, ExtraArgs=extra_args, Config=transfer_config,
+                             Callback=progress)
+        return obj["Size"]
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="S3") as executor:
+        futures = [executor.submit(fetch, item) for item in todo]
+        errors = [future.exception() for future in futures]
+    failed = [error for error in errors if error is not None]
+    cancelled = [error for error in failed if isinstance(error, DownloadCancelled)]
+    if cancelled:
+        raise cancelled[0]
+    if failed:
+        raise ValueError("Failed to download {} of {} objects: {}".format(
+            len(failed), len(todo), failed[0])) from failed[0]
+    log(log_path, "Downloaded {} objects ({:.1f} MB).".format(len(todo), sum(o["Size"] for o, _ in todo) / 2 ** 20),
+        indent=2)
+    return sum(obj["Size"] for obj, _ in todo)
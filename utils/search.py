@@ -0,0 +1,83 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Time-windowed parallel search for the OData APIs.
+
+Long searches are split into windows of search_window_days days which are queried by search_workers threads, each
+window following its own result pages. The products of all windows are merged, products returned by two windows
+(sensing start on a window boundary) are kept once.
+"""
+
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.auxil import log
+
+# Default length of the search windows in days
+DEFAULT_WINDOW_DAYS = 30
+# Default number of windows searched in parallel
+DEFAULT_WORKERS = 4
+
+
+def format_date(date):
+    """Format a date like the start and end of the parameter files, e.g. 2024-07-17T00:00:00.000Z."""
+    return date.strftime("%Y-%m-%dT%H:%M:%S.") + "{:03d}Z".format(date.microsecond // 1000)
+
+
+def split_time_range(start_date, end_date, window_days):
+    """Split [start_date, end_date] into consecutive windows of at most window_days days."""
+    start = datetime.fromisoformat(start_date.replace("Z", ""))
+    end = datetime.fromisoformat(end_date.replace("Z", ""))
+    windows = []
+    window_start = start_date
+    while start + timedelta(days=window_days) < end:
+        start += timedelta(days=window_days)
+        windows.append((window_start, format_date(start)))
+        window_start = format_date(start)
+    windows.append((window_start, end_date))
+    return windows
+
+
+def search_time_windows(search_window, start_date, end_date, env, key="uuid"):
+    """
+    Search [start_date, end_date] window by window in parallel.
+
+    Parameters
+    ----------
+
+    search_window
+        Function returning the list of products for a (start_date, end_date) window
+    start_date
+        Start of the search
+    end_date
+        End of the search
+    env
+        Dictionary of environment parameters, for the search_window_days and search_workers settings and the log
+    key
+        | **Default: "uuid"**
+        | Key of the product dictionaries identifying a product, used to remove duplicates
+
+    Returns
+    -------
+    The products of all windows ordered by sensing start
+    """
+    window_days = int(env["General"]["search_window_days"]) if "search_window_days" in env["General"] and \
+        env["General"]["search_window_days"] else DEFAULT_WINDOW_DAYS
+    workers = int(env["General"]["search_workers"]) if "search_workers" in env["General"] and \
+        env["General"]["search_workers"] else DEFAULT_WORKERS
+    windows = split_time_range(start_date, end_date, window_days)
+    if len(windows) == 1:
+        return search_window(start_date, end_date)
+
+    log(env["General"]["log"], "Searching {} time windows of {} days with {} workers.".format(
+        len(windows), window_days, workers))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Search") as executor:
+        results = list(executor.map(lambda window: search_window(*window), windows))
+    products, seen = [], set()
+    for window_products in results:
+        for product in window_products:
+            if product[key] not in seen:
+                seen.add(product[key])
+                products.append(product)
+    return sorted(products, key=lambda p: p["sensing_start"])
@@ -0,0 +1,92 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Static partitioning of the product groups of one run into shards, e.g. for the tasks of a Slurm or PBS job array.
+
+Every group is assigned to a shard by a stable hash of its key, so all shards agree on the partition without any
+communication. Each shard writes its summary to the Shards folder of the output folder, merge_shard_summaries
+aggregates them once all shards have finished.
+"""
+
+import os
+import json
+import zlib
+
+from utils.telemetry import write_telemetry
+
+# The name of the folder within the output folder holding the summaries of the shards
+SHARD_DIR = "Shards"
+
+
+def parse_shard(shard):
+    """Parse a shard given as "i/n" (0 <= i < n) into the tuple (i, n)."""
+    try:
+        index, count = (int(part) for part in shard.split("/"))
+    except ValueError:
+        raise ValueError("Shard must be given as i/n, not {}".format(shard))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError("Shard index must be between 0 and {}, not {}".format(count - 1, index))
+    return index, count
+
+
+def get_shard(group, count):
+    """Return the shard of a group. Unlike hash(), crc32 does not change between interpreter runs."""
+    return zlib.crc32(group.encode("utf-8")) % count
+
+
+def filter_groups(product_groups, shard):
+    """Return the product groups belonging to the shard (i, n)."""
+    index, count = shard
+    return {group: products for group, products in product_groups.items() if get_shard(group, count) == index}
+
+
+def get_summary_file(l2_path, shard):
+    return os.path.join(l2_path, SHARD_DIR, "summary_{}_of_{}.json".format(*shard))
+
+
+def write_shard_summary(l2_path, shard, summary, l2product_files):
+    """Write the summary and the l2 product files of a shard."""
+    os.makedirs(os.path.join(l2_path, SHARD_DIR), exist_ok=True)
+    summary_file = get_summary_file(l2_path, shard)
+    with open(summary_file + ".tmp", "w") as f:
+        json.dump({"shard": list(shard), "summary": summary, "l2product_files": l2product_files}, f, indent=2,
+                  default=str)
+    os.replace(summary_file + ".tmp", summary_file)
+    return summary_file
+
+
+def merge_shard_summaries(l2_path, log_file):
+    """
+    Aggregate the summaries of all shards of a run.
+
+    Parameters
+    ----------
+
+    l2_path
+        The output folder of the run
+    log_file
+        Log file of the merge, the merged telemetry is written next to it
+
+    Returns
+    -------
+    Tuple of the merged summary, the merged l2 product files and the list of the indices of the missing shards
+    """
+    folder = os.path.join(l2_path, SHARD_DIR)
+    files = [f for f in os.listdir(folder) if f.startswith("summary_") and f.endswith(".json")] \
+        if os.path.isdir(folder) else []
+    if not files:
+        raise RuntimeError("No shard summaries found in {}".format(folder))
+    summary, l2product_files, found, counts = [], {}, set(), set()
+    for file in sorted(files):
+        with open(os.path.join(folder, file), "r") as f:
+            content = json.load(f)
+        found.add(content["shard"][0])
+        counts.add(content["shard"][1])
+        summary.extend(content["summary"])
+        l2product_files.update(content["l2product_files"])
+    if len(counts) != 1:
+        raise RuntimeError("Shard summaries of different shard counts {} found in {}".format(sorted(counts), folder))
+    missing = [index for index in range(counts.pop()) if index not in found]
+    write_telemetry(log_file, summary)
+    return summary, l2product_files, missing
@@ -0,0 +1,114 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Per-stage timing and resource telemetry for the Sencast run summary.
+
+Every download, processor, mosaic and adapter step records its wall time, CPU time (of the running thread and of the
+child processes such as GPT which finished during the step), peak RSS of Sencast and of its child processes and the
+bytes read from and written to storage. Waits on the download, process and adapt semaphores are recorded as separate
+"wait" entries. I/O and child process counters are process wide, so with several parallel steps they are shared
+between the steps running at the same time. The summary is written as JSON and CSV next to the log file.
+"""
+
+import os
+import csv
+import json
+import time
+import contextlib
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Fields of a summary entry, in the order of the CSV columns
+SUMMARY_FIELDS = ["group", "type", "name", "status", "input", "output", "time", "cpu_time", "wait_time",
+                  "peak_rss_mb", "children_peak_rss_mb", "read_bytes", "write_bytes", "message"]
+
+
+def get_children_cpu_time():
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def get_peak_rss_mb(who):
+    """Return the peak resident set size in MB of this process (who="self") or of its finished children."""
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kilobytes on Linux
+    return round(usage.ru_maxrss / 1024, 1)
+
+
+def get_io_bytes():
+    """Return the bytes read from and written to storage by this process, if available (Linux only)."""
+    counters = {"read_bytes": 0, "write_bytes": 0}
+    try:
+        with open("/proc/self/io", "r") as f:
+            for line in f:
+                key, value = line.split(":")
+                if key in counters:
+                    counters[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters
+
+
+class StageTimer(object):
+    """Measures the telemetry of one stage from its creation until stop() is called."""
+
+    def __init__(self, wait_time=0.0):
+        self.wait_time = wait_time
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.thread_time()
+        self.start_children_cpu = get_children_cpu_time()
+        self.start_io = get_io_bytes()
+
+    def elapsed(self):
+        return time.perf_counter() - self.start_wall
+
+    def stop(self):
+        """Return the telemetry fields of the stage, to be merged into its summary entry."""
+        io = get_io_bytes()
+        cpu = time.thread_time() - self.start_cpu + get_children_cpu_time() - self.start_children_cpu
+        return {
+            "time": round(self.elapsed(), 3),
+            "cpu_time": round(cpu, 3),
+            "wait_time": round(self.wait_time, 3),
+            "peak_rss_mb": get_peak_rss_mb("self"),
+            "children_peak_rss_mb": get_peak_rss_mb("children"),
+            "read_bytes": io["read_bytes"] - self.start_io["read_bytes"],
+            "write_bytes": io["write_bytes"] - self.start_io["write_bytes"],
+        }
+
+
+@contextlib.contextmanager
+def timed_acquire(semaphore):
+    """Acquire a semaphore for the duration of the context and yield the seconds waited for it."""
+    start = time.perf_counter()
+    with semaphore:
+        yield round(time.perf_counter() - start, 3)
+
+
+def wait_entry(group, name, wait_time):
+    """Return a summary entry for the wait of a group on the semaphore with the given name."""
+    return {"group": group, "input": "", "output": "", "type": "wait", "name": name, "status": "Succeeded",
+            "time": 0, "wait_time": wait_time, "message": ""}
+
+
+def write_telemetry(log_file, summary):
+    """Write the summary with its telemetry as JSON and CSV next to the log file. Returns the JSON file."""
+    base = os.path.splitext(log_file)[0]
+    entries = [{field: str(s.get(field, "")) if field == "message" else s.get(field, "") for field in SUMMARY_FIELDS}
+               for s in summary]
+    with open(base + "_telemetry.json", "w") as f:
+        json.dump(entries, f, indent=2, default=str)
+    with open(base + "_telemetry.csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=SUMMARY_FIELDS)
+        writer.writeheader()
+        for entry in entries:
+            writer.writerow(entry)
+    return base + "_telemetry.json"
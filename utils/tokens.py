@@ -0,0 +1,101 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Access token cache shared by all download threads of a backend.
+
+A token is fetched once and reused until shortly before it expires. Tokens are then renewed with the refresh token
+if the backend issued one, and only fetched again with the credentials (for CREODIAS including a new TOTP) when the
+refresh token expired as well or was rejected. One lock per backend and user ensures that parallel downloads wait for
+a single renewal instead of all requesting a token at the same time.
+"""
+
+import time
+from threading import Lock
+
+from utils.auxil import log
+
+# Seconds before the expiry at which a token is renewed
+EXPIRY_MARGIN = 60
+
+_caches = {}
+_caches_lock = Lock()
+
+
+class TokenCache(object):
+    """
+    Cache of the access token of one backend and user.
+
+    Parameters
+    ----------
+
+    name
+        Name of the backend, for the log
+    fetch
+        Function returning a new token response ({"access_token", "expires_in", optionally "refresh_token" and
+        "refresh_expires_in"}) from the credentials
+    refresh
+        | **Default: None**
+        | Function returning a new token response from a refresh token, None if the backend has no refresh tokens
+    lifetime
+        | **Default: 600**
+        | Lifetime in seconds of tokens for which the response has no expires_in
+    """
+
+    def __init__(self, name, fetch, refresh=None, lifetime=600):
+        self.name = name
+        self.fetch = fetch
+        self.refresh = refresh
+        self.lifetime = lifetime
+        self.lock = Lock()
+        self.token = None
+        self.expires = 0
+        self.refresh_token = None
+        self.refresh_expires = 0
+
+    def get(self, log_path):
+        """Return a valid access token, renewing it if needed."""
+        with self.lock:
+            now = time.time()
+            if self.token and now < self.expires - EXPIRY_MARGIN:
+                return self.token
+            response = None
+            if self.refresh and self.refresh_token and now < self.refresh_expires - EXPIRY_MARGIN:
+                try:
+                    response = self.refresh(self.refresh_token)
+                    log(log_path, "{} token refreshed.".format(self.name), indent=2)
+                except Exception as e:
+                    log(log_path, "Failed to refresh {} token: {}".format(self.name, e), indent=2)
+            if response is None:
+                response = self.fetch()
+                log(log_path, "Authentication successful.", indent=2)
+            self.store(response, now)
+            return self.token
+
+    def store(self, response, now):
+        self.token = response["access_token"]
+        self.expires = now + float(response.get("expires_in") or self.lifetime)
+        self.refresh_token = response.get("refresh_token")
+        self.refresh_expires = now + float(response.get("refresh_expires_in") or 0)
+
+    def invalidate(self):
+        """Discard the access token, e.g. after it was rejected. The refresh token is kept."""
+        with self.lock:
+            self.token = None
+            self.expires = 0
+
+
+def get_token_cache(name, user, fetch, refresh=None, lifetime=600):
+    """Return the token cache of a backend and user, creating it on first use."""
+    with _caches_lock:
+        if (name, user) not in _caches:
+            _caches[(name, user)] = TokenCache(name, fetch, refresh, lifetime)
+        return _caches[(name, user)]
+
+
+def invalidate_token(name, user):
+    """Discard the cached access token of a backend and user, if there is one."""
+    with _caches_lock:
+        cache = _caches.get((name, user))
+    if cache is not None:
+        cache.invalidate()